@@ -1,93 +1,667 @@
 import os
+import logging
+import time
+import asyncio
 import aiohttp
 import uuid
 import json
-from typing import Optional, Dict, Any
+import heapq
+import random
+import itertools
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from urllib.parse import quote
+from typing import Optional, Dict, Any, Awaitable, Callable
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
-from bot.utils import generate_sub_id, generate_expiry, generate_email, generate_uuid
+from bot.metrics import (
+    PANEL_REQUEST_DURATION, PANEL_REQUESTS, PANEL_RESPONSE_SIZE, PANEL_GATE_WAIT, CACHE_REQUESTS, Gauge
+)
+from bot.utils import generate_sub_id, generate_expiry, generate_email, generate_uuid, get_expiry_datetime
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 XUI_API_URL = os.getenv("XUI_API_URL")
 XUI_USERNAME = os.getenv("XUI_USERNAME")
 XUI_PASSWORD = os.getenv("XUI_PASSWORD")
+# JSON-список панелей: [{"name": "de", "url": "...", "username": "...", "password": "..."}]
+XUI_PANELS = os.getenv("XUI_PANELS")
+CLIENT_INDEX_TTL = float(os.getenv("CLIENT_INDEX_TTL", "60"))
 
-cookies = {}
-_client_session: Optional[aiohttp.ClientSession] = None
-
-async def get_session() -> aiohttp.ClientSession:
-    global _client_session
-    if _client_session is None or _client_session.closed:
-        _client_session = aiohttp.ClientSession()
-    return _client_session
-
-async def login() -> bool:
-    global cookies
-    session = await get_session()
-    async with session.post(
-        f"{XUI_API_URL}/login",
-        json={"username": XUI_USERNAME, "password": XUI_PASSWORD},
-    ) as resp:
-        if resp.status == 200:
-            cookies = resp.cookies
-            print("[api.py] ✅ Успешный логин, cookie сохранена")
-            return True
-        print(f"[api.py] ❌ Ошибка логина: {resp.status}")
-        return False
+PANEL_TIMEOUT = float(os.getenv("PANEL_TIMEOUT", "15"))
+PANEL_CONNECT_TIMEOUT = float(os.getenv("PANEL_CONNECT_TIMEOUT", "5"))
+PANEL_POOL_SIZE = int(os.getenv("PANEL_POOL_SIZE", "20"))
+PANEL_KEEPALIVE = float(os.getenv("PANEL_KEEPALIVE", "30"))
+PANEL_DNS_CACHE_TTL = int(os.getenv("PANEL_DNS_CACHE_TTL", "300"))
+# Сколько ждать один узел при опросе всех панелей сразу
+PANEL_NODE_TIMEOUT = float(os.getenv("PANEL_NODE_TIMEOUT", str(PANEL_TIMEOUT)))
+# Политика выбора inbound для новых клиентов: count, traffic или weight
+PLACEMENT_POLICY = os.getenv("PLACEMENT_POLICY", "count")
+# Веса inbound'ов в формате "node:inbound_id=weight,..."; вес 0 исключает inbound
+INBOUND_WEIGHTS = os.getenv("INBOUND_WEIGHTS", "")
+# Сколько запросов ко всем панелям может выполняться одновременно
+PANEL_MAX_CONCURRENCY = int(os.getenv("PANEL_MAX_CONCURRENCY", "8"))
+# Повторы чтения при сетевых ошибках и 5xx: число повторов и границы задержки (full jitter)
+PANEL_RETRIES = int(os.getenv("PANEL_RETRIES", "2"))
+PANEL_RETRY_BASE_DELAY = float(os.getenv("PANEL_RETRY_BASE_DELAY", "0.3"))
+PANEL_RETRY_MAX_DELAY = float(os.getenv("PANEL_RETRY_MAX_DELAY", "3"))
+# Circuit breaker: после N ошибок подряд панель считается недоступной на M секунд
+PANEL_BREAKER_THRESHOLD = int(os.getenv("PANEL_BREAKER_THRESHOLD", "5"))
+PANEL_BREAKER_RESET = float(os.getenv("PANEL_BREAKER_RESET", "30"))
+# Stale-while-revalidate: сколько ждать свежие данные, прежде чем отдать последний снимок
+PANEL_STALE_WHILE_REVALIDATE = os.getenv("PANEL_STALE_WHILE_REVALIDATE", "1") == "1"
+PANEL_STALE_WAIT = float(os.getenv("PANEL_STALE_WAIT", "3"))
+
+# Учёт трафика: сколько запросов и байт ответа пришлось на каждую операцию
+transfer_stats: Dict[str, Dict[str, int]] = {}
+
+def get_transfer_stats() -> Dict[str, Dict[str, int]]:
+    return {op: dict(stats) for op, stats in transfer_stats.items()}
+
+# Приоритеты запросов к панели: меньше — важнее
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+_panel_priority: ContextVar[int] = ContextVar("panel_priority", default=INTERACTIVE)
+
+@contextmanager
+def panel_priority(priority: int):
+    """Задаёт приоритет всех запросов к панели внутри блока (и порождённых в нём задач)"""
+    token = _panel_priority.set(priority)
+    try:
+        yield
+    finally:
+        _panel_priority.reset(token)
+
+class PriorityGate:
+    """Общий лимит одновременных запросов; освободившийся слот получает самый приоритетный ожидающий"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self.wait_stats: Dict[str, Dict[str, float]] = {
+            name: {"count": 0, "total": 0.0, "max": 0.0} for name in PRIORITY_NAMES.values()
+        }
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    async def acquire(self, priority: int):
+        started = time.monotonic()
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            # seq сохраняет порядок FIFO внутри одного приоритета
+            heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                # Слот уже передали нам, но задачу отменили — отдаём его следующему
+                if fut.done() and not fut.cancelled():
+                    self.release()
+                raise
+
+        waited = time.monotonic() - started
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        PANEL_GATE_WAIT.observe(waited, priority=name)
+        stats = self.wait_stats[name]
+        stats["count"] += 1
+        stats["total"] += waited
+        stats["max"] = max(stats["max"], waited)
+
+    def release(self):
+        # Слот передаётся ожидающему напрямую, счётчик active не меняется
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+panel_gate = PriorityGate(PANEL_MAX_CONCURRENCY)
+
+PANEL_GATE = Gauge(
+    "bot_panel_gate_requests", "Запросы к панели: выполняются и ждут слота", ("state",),
+    callback=lambda: {("active",): panel_gate.active, ("queued",): panel_gate.queued}
+)
+
+def get_scheduler_stats() -> Dict[str, Any]:
+    return {
+        "active": panel_gate.active,
+        "queued": panel_gate.queued,
+        "wait": {
+            name: {
+                "count": int(stats["count"]),
+                "avg": stats["total"] / stats["count"] if stats["count"] else 0.0,
+                "max": stats["max"],
+            }
+            for name, stats in panel_gate.wait_stats.items()
+        },
+    }
+
+class PanelUnavailableError(Exception):
+    """Панель недоступна: circuit breaker открыт или данных нет ни от одного узла"""
+
+class CircuitBreaker:
+    """closed → open после серии ошибок → half_open с одним пробным запросом → closed"""
+
+    def __init__(self, name: str, threshold: int, reset_timeout: float):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise PanelUnavailableError(f"панель {self.name} недоступна")
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                raise PanelUnavailableError(f"панель {self.name} недоступна")
+            self._probe_in_flight = True
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"✅ [{self.name}] Панель снова доступна")
+        self.state = "closed"
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                logger.warning(f"🚫 [{self.name}] Панель недоступна, пауза {self.reset_timeout:.0f} с")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        # Пробный запрос отменили — даём шанс следующему
+        self._probe_in_flight = False
+
+class PanelClient:
+    """Сессия к одной панели 3x-ui: cookie, пул соединений и повторный логин"""
+
+    # Редирект с API-маршрута означает, что панель отправляет нас на страницу логина
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+    def __init__(self, name: str, base_url: str, username: str, password: str, weight: float = 1.0):
+        self.name = name
+        self.weight = weight
+        self.base_url = (base_url or "").rstrip("/")
+        self.username = username
+        self.password = password
+        # Старые версии 3x-ui не знают /panel/api/inbounds/* — тогда работаем через полный список
+        self.targeted_api = True
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._login_lock = asyncio.Lock()
+        # Растёт при каждом успешном логине; по нему видно, что сессию уже обновил кто-то другой
+        self._auth_generation = 0
+        self.breaker = CircuitBreaker(name, PANEL_BREAKER_THRESHOLD, PANEL_BREAKER_RESET)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=PANEL_POOL_SIZE,
+                limit_per_host=PANEL_POOL_SIZE,
+                ttl_dns_cache=PANEL_DNS_CACHE_TTL,
+                keepalive_timeout=PANEL_KEEPALIVE,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                # unsafe=True: панель часто доступна по IP, а такие cookie по умолчанию отбрасываются
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                timeout=aiohttp.ClientTimeout(total=PANEL_TIMEOUT, connect=PANEL_CONNECT_TIMEOUT),
+                headers={"X-Requested-With": "XMLHttpRequest"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    async def login(self) -> bool:
+        session = self._get_session()
+        session.cookie_jar.clear()
+        async with session.post(
+            f"{self.base_url}/login",
+            json={"username": self.username, "password": self.password},
+        ) as resp:
+            if resp.status == 200:
+                self._auth_generation += 1
+                logger.info(f"✅ [{self.name}] Успешный логин, cookie сохранена")
+                return True
+            logger.error(f"❌ [{self.name}] Ошибка логина: {resp.status}")
+            return False
+
+    async def _relogin(self, seen_generation: int) -> bool:
+        # Один общий логин: остальные ждут lock и видят, что поколение уже сменилось
+        async with self._login_lock:
+            if self._auth_generation != seen_generation:
+                return True
+            if seen_generation:
+                logger.info(f"🔑 [{self.name}] Сессия панели истекла, повторный логин")
+            return await self.login()
+
+    async def request(self, op: str, method: str, path: str, auth_statuses: tuple = (401,),
+                      retry: bool = False, **kwargs) -> tuple[int, Optional[dict]]:
+        """retry=True только для идемпотентных запросов: запись может выполниться дважды"""
+        attempts = 1 + (PANEL_RETRIES if retry else 0)
+        for attempt in range(attempts):
+            self.breaker.before_call()
+            try:
+                # Между повторами слот не держим, чтобы не мешать остальным
+                async with panel_gate.slot(_panel_priority.get()):
+                    status, data = await self._request(op, method, path, auth_statuses, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                PANEL_REQUESTS.inc(node=self.name, op=op, status="error")
+                self.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+                reason = f"{type(e).__name__}: {e}"
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            else:
+                if status < 500:
+                    self.breaker.record_success()
+                    return status, data
+                self.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    return status, data
+                reason = f"HTTP {status}"
+
+            delay = random.uniform(0, min(PANEL_RETRY_MAX_DELAY, PANEL_RETRY_BASE_DELAY * 2 ** attempt))
+            logger.info(f"🔁 [{self.name}] {op}: {reason}, повтор через {delay:.2f} с")
+            await asyncio.sleep(delay)
+
+    async def _request(self, op: str, method: str, path: str, auth_statuses: tuple,
+                       **kwargs) -> tuple[int, Optional[dict]]:
+        if self._auth_generation == 0:
+            await self._relogin(0)
+
+        session = self._get_session()
+        for attempt in range(2):
+            generation = self._auth_generation
+            with PANEL_REQUEST_DURATION.time(node=self.name, op=op):
+                async with session.request(
+                    method, f"{self.base_url}{path}", allow_redirects=False, **kwargs
+                ) as resp:
+                    status = resp.status
+                    body = await resp.read()
+            PANEL_REQUESTS.inc(node=self.name, op=op, status=status)
+            PANEL_RESPONSE_SIZE.observe(len(body), node=self.name, op=op)
+
+            stats = transfer_stats.setdefault(op, {"requests": 0, "bytes": 0})
+            stats["requests"] += 1
+            stats["bytes"] += len(body)
+
+            if attempt == 0 and (status in auth_statuses or status in self.REDIRECT_STATUSES):
+                if not await self._relogin(generation):
+                    break
+                continue
+            break
+
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+        return status, data
+
+
+def _load_panels() -> Dict[str, PanelClient]:
+    if XUI_PANELS:
+        result = {}
+        for item in json.loads(XUI_PANELS):
+            name = item["name"]
+            result[name] = PanelClient(
+                name,
+                item["url"],
+                item.get("username", XUI_USERNAME),
+                item.get("password", XUI_PASSWORD),
+                float(item.get("weight", 1.0)),
+            )
+        return result
+    return {"main": PanelClient("main", XUI_API_URL, XUI_USERNAME, XUI_PASSWORD)}
+
+# Узлы в порядке конфигурации; первый используется по умолчанию
+panels: Dict[str, PanelClient] = _load_panels()
+DEFAULT_NODE = next(iter(panels))
+
+def get_panel(node: Optional[str] = None) -> PanelClient:
+    return panels[node or DEFAULT_NODE]
+
+async def login(node: Optional[str] = None) -> bool:
+    return await get_panel(node).login()
+
+async def close_panel():
+    await asyncio.gather(*(p.close() for p in panels.values()))
 
-async def get_inbounds() -> Optional[list[dict]]:
-    if not cookies:
-        await login()
-    session = await get_session()
-    async with session.post(f"{XUI_API_URL}/panel/inbound/list", cookies=cookies) as resp:
-        if resp.status == 200:
-            data = await resp.json()
-            return data.get("obj", [])
-        print(f"[api.py] ❌ Ошибка при получении inbounds: {resp.status}")
+async def _fan_out(fetch: Callable[[PanelClient], Awaitable[Any]]) -> Dict[str, Any]:
+    """Опрашивает все узлы параллельно; упавший или медленный узел не задерживает остальных"""
+    names = list(panels)
+    results = await asyncio.gather(
+        *(asyncio.wait_for(fetch(panels[name]), PANEL_NODE_TIMEOUT) for name in names),
+        return_exceptions=True,
+    )
+    merged = {}
+    for name, result in zip(names, results):
+        if isinstance(result, asyncio.TimeoutError):
+            logger.warning(f"⏱ [{name}] Узел не ответил за {PANEL_NODE_TIMEOUT:.0f} с")
+        elif isinstance(result, Exception):
+            logger.error(f"❌ [{name}] Ошибка узла: {result}")
+        else:
+            merged[name] = result
+    return merged
+
+# Single-flight: одновременные вызовы с одним ключом ждут один общий запрос
+_inflight: Dict[str, asyncio.Task] = {}
+coalesce_stats: Dict[str, int] = {"calls": 0, "fetches": 0, "deduplicated": 0}
+
+def _finish_flight(key: str, task: asyncio.Task):
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    # Забираем исключение, чтобы не было предупреждения, если все ожидающие отменены
+    if not task.cancelled():
+        task.exception()
+
+async def _single_flight(key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """Результат общий для всех ожидающих — его нельзя изменять на месте"""
+    coalesce_stats["calls"] += 1
+    task = _inflight.get(key)
+    if task is None:
+        coalesce_stats["fetches"] += 1
+        CACHE_REQUESTS.inc(cache="single_flight", result="miss")
+        task = asyncio.ensure_future(fetch())
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _finish_flight(key, t))
+    else:
+        coalesce_stats["deduplicated"] += 1
+        CACHE_REQUESTS.inc(cache="single_flight", result="hit")
+    # shield: отмена одного вызывающего не отменяет запрос для остальных
+    return await asyncio.shield(task)
+
+def get_coalesce_stats() -> Dict[str, int]:
+    return dict(coalesce_stats)
+
+async def get_inbounds(node: Optional[str] = None) -> Optional[list[dict]]:
+    panel = get_panel(node)
+    return await _single_flight(f"inbounds:{panel.name}", lambda: _fetch_inbounds(panel))
+
+async def _fetch_inbounds(panel: PanelClient) -> Optional[list[dict]]:
+    status, data = await panel.request("list_inbounds", "POST", "/panel/inbound/list", retry=True)
+    if status == 200 and data is not None:
+        return data.get("obj", [])
+    logger.error(f"❌ [{panel.name}] Ошибка при получении inbounds: {status}")
+    return None
+
+async def _targeted_get(panel: PanelClient, op: str, path: str) -> tuple[bool, Optional[dict]]:
+    """Возвращает (поддерживается ли точечный маршрут, obj из ответа)"""
+    if not panel.targeted_api:
+        return False, None
+    # Новые версии 3x-ui отвечают 404 на /panel/api без авторизации — сначала перелогиниваемся
+    status, data = await panel.request(op, "GET", path, auth_statuses=(401, 404), retry=True)
+    if status == 200 and data is not None:
+        return True, data.get("obj") if data.get("success") else None
+    if status == 404:
+        panel.targeted_api = False
+        logger.warning(f"⚠️ [{panel.name}] Панель не поддерживает /panel/api/inbounds, используем полный список")
+    else:
+        logger.error(f"❌ [{panel.name}] Ошибка точечного запроса {op}: {status}")
+    return False, None
+
+async def get_inbound(inbound_id: int, node: Optional[str] = None) -> Optional[dict]:
+    panel = get_panel(node)
+    supported, inbound = await _targeted_get(panel, "get_inbound", f"/panel/api/inbounds/get/{inbound_id}")
+    if supported:
+        return inbound
+    inbounds = await get_inbounds(panel.name)
+    return next((i for i in inbounds or [] if i["id"] == inbound_id), None)
+
+async def get_client_traffic(email: str, node: Optional[str] = None) -> Optional[dict]:
+    _, traffic = await _targeted_get(
+        get_panel(node), "get_client_traffic", f"/panel/api/inbounds/getClientTraffics/{quote(email, safe='')}"
+    )
+    return traffic
+
+def _tag_client(client: dict, inbound: dict, node: str) -> dict:
+    client["inbound_id"] = inbound["id"]
+    client["inbound_remark"] = inbound.get("remark")
+    client["node"] = node
+    return client
+
+def _find_client(inbound: dict, node: str, predicate: Callable[[dict], bool]) -> Optional[dict]:
+    try:
+        settings = json.loads(inbound.get("settings", "{}"))
+    except ValueError as e:
+        logger.warning(f"⚠️ [{node}] Ошибка разбора settings inbound {inbound.get('id')}: {e}",
+                       extra={"sample": "inbound_settings"})
         return None
+    for client in settings.get("clients", []):
+        if predicate(client):
+            return _tag_client(client, inbound, node)
+    return None
+
+class ClientIndex:
+    """Индекс клиентов всех панелей по tgId, id, email и subId с ограниченным временем жизни"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.by_tg: Dict[str, dict] = {}
+        self.by_id: Dict[str, dict] = {}
+        # email уникален только в пределах одной панели
+        self.by_email: Dict[tuple, dict] = {}
+        self.by_sub: Dict[str, dict] = {}
+        self.built_at = 0.0
+
+    def is_fresh(self) -> bool:
+        return self.built_at > 0 and time.monotonic() - self.built_at < self.ttl
+
+    def invalidate(self):
+        self.built_at = 0.0
+
+    def replace_node(self, node: str, clients: list[dict]):
+        # Записи недоступных узлов не трогаем, чтобы их клиенты не «исчезали»
+        for client in [c for c in self.by_id.values() if c.get("node") == node]:
+            self._remove(client)
+        for client in clients:
+            self._add(client)
+
+    def mark_built(self):
+        self.built_at = time.monotonic()
+
+    def upsert(self, client: dict):
+        # Убираем старую запись клиента, если email или subId изменились
+        old = self.by_id.get(client.get("id"))
+        if old:
+            self._remove(old)
+        self._add(client)
+
+    def get_by_tg(self, tg_id) -> Optional[dict]:
+        return self.by_tg.get(str(tg_id))
+
+    def get_by_id(self, client_id: str) -> Optional[dict]:
+        return self.by_id.get(client_id)
+
+    def get_by_email(self, email: str, node: Optional[str] = None) -> Optional[dict]:
+        return self.by_email.get((node or DEFAULT_NODE, email))
+
+    def get_by_sub(self, sub_id: str) -> Optional[dict]:
+        return self.by_sub.get(sub_id)
+
+    def _add(self, client: dict):
+        if client.get("tgId"):
+            self.by_tg[str(client["tgId"])] = client
+        if client.get("id"):
+            self.by_id[client["id"]] = client
+        if client.get("email"):
+            self.by_email[(client.get("node"), client["email"])] = client
+        if client.get("subId"):
+            self.by_sub[client["subId"]] = client
+
+    def _remove(self, client: dict):
+        for mapping, key in (
+            (self.by_tg, str(client.get("tgId"))),
+            (self.by_id, client.get("id")),
+            (self.by_email, (client.get("node"), client.get("email"))),
+            (self.by_sub, client.get("subId")),
+        ):
+            if mapping.get(key) is client:
+                del mapping[key]
+
+
+client_index = ClientIndex(CLIENT_INDEX_TTL)
+
+def invalidate_client_index():
+    client_index.invalidate()
+
+def _as_user(client: dict, stale: bool = False) -> Dict[str, Any]:
+    return {
+        "node": client["node"],
+        "inbound_id": client["inbound_id"],
+        "client": client,
+        "subId": client.get("subId"),
+        "expiryTime": client.get("expiryTime"),
+        # True — данные из последнего снимка и могут быть неактуальны
+        "stale": stale,
+    }
 
 async def get_all_clients() -> list[dict]:
+    clients, _ = await get_all_clients_with_failures()
+    return clients
+
+async def get_all_clients_with_failures() -> tuple[list[dict], list[str]]:
+    """Клиенты ответивших узлов и имена узлов, которые не ответили: список может быть неполным"""
+    return await _single_flight("clients", _fetch_all_clients)
+
+async def _fetch_node_clients(panel: PanelClient) -> list[dict]:
+    inbounds = await get_inbounds(panel.name)
+    if inbounds is None:
+        raise RuntimeError("не удалось получить inbounds")
     clients = []
-    inbounds = await get_inbounds()
-    if not inbounds:
-        return clients
     for inbound in inbounds:
         try:
             settings = json.loads(inbound.get("settings", "{}"))
             for client in settings.get("clients", []):
-                client["inbound_id"] = inbound["id"]
-                client["inbound_remark"] = inbound["remark"]
-                clients.append(client)
+                clients.append(_tag_client(client, inbound, panel.name))
         except Exception as e:
-            print(f"[api.py] ⚠️ Ошибка в get_all_clients: {e}")
+            logger.warning(f"⚠️ [{panel.name}] Ошибка в get_all_clients: {e}")
     return clients
 
-async def find_user_by_tg(tg_id: int) -> Optional[Dict[str, Any]]:
-    inbounds = await get_inbounds()
-    if not inbounds:
-        return None
-    for inbound in inbounds:
+async def _fetch_all_clients() -> tuple[list[dict], list[str]]:
+    by_node = await _fan_out(_fetch_node_clients)
+    clients = []
+    for node, node_clients in by_node.items():
+        # Полный список узла уже получен — заодно обновляем индекс
+        client_index.replace_node(node, node_clients)
+        clients.extend(node_clients)
+    if by_node:
+        client_index.mark_built()
+    return clients, [name for name in panels if name not in by_node]
+
+def _consume_result(task: asyncio.Task):
+    if not task.cancelled():
+        task.exception()
+
+async def find_user_by_tg(tg_id: int, allow_stale: bool = True,
+                          raise_unavailable: bool = False) -> Optional[Dict[str, Any]]:
+    """allow_stale=False — для записи: данные перечитываются из панели, даже если индекс свежий.
+    raise_unavailable=True — недоступная панель даёт PanelUnavailableError, а не None, как для ненайденного"""
+    # Индекс может отставать на CLIENT_INDEX_TTL: новая дата, посчитанная от него, затёрла бы правку админа в панели
+    if allow_stale and client_index.is_fresh():
+        CACHE_REQUESTS.inc(cache="client_index", result="hit")
+        client = client_index.get_by_tg(tg_id)
+        return _as_user(client) if client else None
+
+    CACHE_REQUESTS.inc(cache="client_index", result="miss")
+    known = client_index.get_by_tg(tg_id)
+    refresh = asyncio.ensure_future(_lookup_fresh(tg_id))
+    if not (allow_stale and PANEL_STALE_WHILE_REVALIDATE and known):
         try:
-            settings = json.loads(inbound.get("settings", "{}"))
-            for client in settings.get("clients", []):
-                if str(client.get("tgId")) == str(tg_id):
-                    return {
-                        "inbound_id": inbound["id"],
-                        "client": client,
-                        "subId": client.get("subId"),
-                        "expiryTime": client.get("expiryTime"),
-                    }
-        except Exception as e:
-            print(f"[api.py] ⚠️ Ошибка при обработке клиента: {e}")
-    return None
+            return await refresh
+        except PanelUnavailableError as e:
+            if raise_unavailable:
+                raise
+            logger.warning(f"⚠️ Не удалось найти пользователя {tg_id}: {e}")
+            return None
+
+    # Ждём свежие данные недолго; если панель тормозит — отдаём снимок, а обновление идёт в фоне
+    try:
+        return await asyncio.wait_for(asyncio.shield(refresh), PANEL_STALE_WAIT)
+    except Exception as e:
+        refresh.add_done_callback(_consume_result)
+        CACHE_REQUESTS.inc(cache="client_index", result="stale")
+        logger.warning(f"⚠️ Отдаём сохранённые данные пользователя {tg_id}: {type(e).__name__}: {e}")
+        return _as_user(known, stale=True)
+
+async def _lookup_fresh(tg_id: int) -> Optional[Dict[str, Any]]:
+    # Индекс устарел: сначала пробуем дешёвый точечный запрос, потом полный список
+    if client_index.built_at:
+        try:
+            client = await _find_client_targeted(tg_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError, PanelUnavailableError) as e:
+            # Узел из индекса не ответил — ищем по полным спискам всех узлов
+            logger.warning(f"⚠️ Точечный поиск {tg_id} не удался, используем полный список: {type(e).__name__}: {e}")
+            client = None
+        if client:
+            client_index.upsert(client)
+            return _as_user(client)
+
+    await get_all_clients()
+    if not client_index.is_fresh():
+        raise PanelUnavailableError("ни один узел не вернул список клиентов")
+    client = client_index.get_by_tg(tg_id)
+    return _as_user(client) if client else None
+
+async def _find_client_targeted(tg_id: int) -> Optional[dict]:
+    def is_user(c: dict) -> bool:
+        return str(c.get("tgId")) == str(tg_id)
 
-async def add_trial_user(inbound_id: int, tg_id: int):
+    known = client_index.get_by_tg(tg_id)
+    if known:
+        inbound = await get_inbound(known["inbound_id"], known["node"])
+        return _find_client(inbound, known["node"], is_user) if inbound else None
+
+    async def lookup(panel: PanelClient) -> Optional[dict]:
+        traffic = await get_client_traffic(generate_email(tg_id), panel.name)
+        if not traffic:
+            return None
+        inbound = await get_inbound(traffic.get("inboundId"), panel.name)
+        return _find_client(inbound, panel.name, is_user) if inbound else None
+
+    found = await _fan_out(lookup)
+    return next((c for c in found.values() if c), None)
+
+async def add_trial_user(inbound_id: int, tg_id: int, node: Optional[str] = None):
+    panel = get_panel(node)
     try:
         # Получаем inbound
-        inbounds = await get_inbounds()
-        inbound = next((i for i in inbounds if i["id"] == inbound_id), None)
+        inbound = await get_inbound(inbound_id, panel.name)
         if not inbound:
-            print(f"[api.py] ❌ Inbound с id={inbound_id} не найден")
+            logger.error(f"❌ [{panel.name}] Inbound с id={inbound_id} не найден")
             return False, None, None
 
         # Формируем нового клиента
@@ -107,73 +681,194 @@ async def add_trial_user(inbound_id: int, tg_id: int):
         settings = json.dumps({"clients": [client]})
 
         # Отправляем POST-запрос
-        session = await get_session()
-        async with session.post(
-            f"{XUI_API_URL}/panel/inbound/addClient",
+        status, result = await panel.request(
+            "add_client",
+            "POST",
+            "/panel/inbound/addClient",
             data={
                 "id": inbound["id"],
                 "settings": settings
             },
-            cookies=cookies,
             headers={"Content-Type": "application/x-www-form-urlencoded"}
-        ) as resp:
-            try:
-                result = await resp.json()
-                print(f"[api.py] ✅ Результат добавления клиента: {result}")
-                return result.get("success", False), client["subId"], client["expiryTime"]
-            except Exception as e:
-                text = await resp.text()
-                print(f"[api.py] ❌ Ошибка при чтении ответа: {e}, текст ответа:\n{text}")
-                return False, None, None
+        )
+        if result is None:
+            logger.error(f"❌ [{panel.name}] Ошибка при чтении ответа ({status})")
+            return False, None, None
+
+        logger.info(f"✅ [{panel.name}] Результат добавления клиента: {result}")
+        success = result.get("success", False)
+        if success:
+            client_index.upsert(_tag_client(client, inbound, panel.name))
+        return success, client["subId"], client["expiryTime"]
     except Exception as e:
-        print(f"[api.py] ❌ Ошибка добавления клиента: {e}")
+        logger.error(f"❌ [{panel.name}] Ошибка добавления клиента: {e}")
         return False, None, None
 
 async def test_api_connection() -> bool:
-    return await login() and (await get_inbounds() is not None)
+    async def check(panel: PanelClient) -> bool:
+        return await panel.login() and (await get_inbounds(panel.name) is not None)
+
+    results = await _fan_out(check)
+    for name in panels:
+        logger.info(f"{'✅' if results.get(name) else '❌'} Узел {name}")
+    return any(results.values())
 
-async def update_user_expiry(inbound_id: int, client_id: str, new_expiry_time: int) -> bool:
+async def update_user_expiry(inbound_id: int, client_id: str, new_expiry_time: int,
+                             node: Optional[str] = None) -> bool:
+    panel = get_panel(node)
     try:
-        session = await get_session()
-        inbounds = await get_inbounds()
-        if not inbounds:
-            print("[api.py] ❌ Не удалось получить список inbounds")
+        # Читаем только нужный inbound, а не весь список
+        inbound = await get_inbound(inbound_id, panel.name)
+        if not inbound:
+            logger.error(f"❌ [{panel.name}] Не удалось получить inbound {inbound_id}")
             return False
 
-        for inbound in inbounds:
-            if inbound["id"] != inbound_id:
-                continue
+        client = _find_client(inbound, panel.name, lambda c: c.get("id") == client_id)
+        if not client:
+            logger.error(f"❌ [{panel.name}] Клиент с id {client_id} не найден.")
+            return False
 
-            settings = json.loads(inbound.get("settings", "{}"))
-            clients = settings.get("clients", [])
-
-            for client in clients:
-                if client.get("id") == client_id:
-                    client["expiryTime"] = new_expiry_time
-
-                    payload = {
-                        "id": str(inbound_id),
-                        "settings": json.dumps({"clients": [client]})
-                    }
-
-                    async with session.post(
-                        f"{XUI_API_URL}/panel/inbound/updateClient/{client_id}",
-                        data=payload,
-                        cookies=cookies,
-                        headers={"Content-Type": "application/x-www-form-urlencoded"}
-                    ) as resp:
-                        text = await resp.text()
-                        if resp.status == 200 and "success" in text:
-                            print(f"[api.py] ✅ Подписка клиента {client_id} успешно продлена.")
-                            return True
-                        else:
-                            print(f"[api.py] ❌ Ошибка продления ({resp.status}): {text}")
-                            return False
-
-        print(f"[api.py] ❌ Клиент с id {client_id} не найден.")
+        client["expiryTime"] = new_expiry_time
+        panel_client = {k: v for k, v in client.items() if k not in ("inbound_id", "inbound_remark", "node")}
+        payload = {
+            "id": str(inbound_id),
+            "settings": json.dumps({"clients": [panel_client]})
+        }
+
+        status, result = await panel.request(
+            "update_client",
+            "POST",
+            f"/panel/inbound/updateClient/{client_id}",
+            data=payload,
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        if status == 200 and result and result.get("success"):
+            logger.info(f"✅ [{panel.name}] Подписка клиента {client_id} успешно продлена.")
+            client_index.upsert(client)
+            return True
+
+        logger.error(f"❌ [{panel.name}] Ошибка продления ({status}): {result}")
         return False
 
     except Exception as e:
-        print(f"[api.py] ❌ Исключение в update_user_expiry: {e}")
+        logger.error(f"❌ [{panel.name}] Исключение в update_user_expiry: {e}")
         return False
 
+async def extend_subscription(user: Dict[str, Any], months: int) -> Optional[datetime]:
+    """Продлевает подписку на N месяцев от текущей даты окончания (или от сегодня); возвращает новую дату"""
+    now = datetime.now(ZoneInfo("Europe/Moscow"))
+    expiry_now = get_expiry_datetime(user["expiryTime"])
+    if not expiry_now or expiry_now < now:
+        expiry_now = now
+
+    base_date = expiry_now.replace(hour=0, minute=0, second=0, microsecond=0)
+    new_expiry = base_date + relativedelta(months=+months)
+    new_expiry = new_expiry.replace(hour=23, minute=59, second=59, microsecond=0)
+
+    success = await update_user_expiry(
+        user["inbound_id"],
+        user["client"]["id"],
+        int(new_expiry.astimezone(timezone.utc).timestamp() * 1000),
+        node=user.get("node")
+    )
+    return new_expiry if success else None
+
+def _parse_inbound_weights(raw: str) -> Dict[tuple, float]:
+    weights = {}
+    for part in raw.split(","):
+        if not part.strip():
+            continue
+        key, _, value = part.partition("=")
+        node, _, inbound_id = key.strip().rpartition(":")
+        weights[(node or DEFAULT_NODE, int(inbound_id))] = float(value)
+    return weights
+
+_inbound_weights = _parse_inbound_weights(INBOUND_WEIGHTS)
+
+# Политики размещения: функция получает кандидата и возвращает оценку, меньше — лучше
+PlacementPolicy = Callable[[Dict[str, Any]], float]
+
+def _score_by_count(candidate: Dict[str, Any]) -> float:
+    return candidate["clients"] / candidate["weight"]
+
+def _score_by_traffic(candidate: Dict[str, Any]) -> float:
+    return candidate["traffic"] / candidate["weight"]
+
+def _score_by_weight(candidate: Dict[str, Any]) -> float:
+    return -candidate["weight"]
+
+PLACEMENT_POLICIES: Dict[str, PlacementPolicy] = {
+    "count": _score_by_count,
+    "traffic": _score_by_traffic,
+    "weight": _score_by_weight,
+}
+
+def register_placement_policy(name: str, policy: PlacementPolicy):
+    PLACEMENT_POLICIES[name] = policy
+
+# Последние суммарные up+down по inbound — чтобы считать трафик за период, а не с момента сброса
+_traffic_samples: Dict[tuple, int] = {}
+
+def _inbound_client_count(inbound: dict) -> int:
+    # clientStats содержит по записи на клиента — не нужно разбирать settings
+    stats = inbound.get("clientStats")
+    if stats is not None:
+        return len(stats)
+    try:
+        return len(json.loads(inbound.get("settings", "{}")).get("clients", []))
+    except ValueError:
+        return 0
+
+async def _placement_candidates() -> list[Dict[str, Any]]:
+    by_node = await _fan_out(lambda p: get_inbounds(p.name))
+    candidates = []
+    for node, inbounds in by_node.items():
+        for inbound in inbounds or []:
+            if not inbound.get("enable", True):
+                continue
+            weight = panels[node].weight * _inbound_weights.get((node, inbound["id"]), 1.0)
+            if weight <= 0:
+                continue
+            total = sum((s.get("up") or 0) + (s.get("down") or 0) for s in inbound.get("clientStats") or [])
+            candidates.append({
+                "node": node,
+                "inbound": inbound,
+                "weight": weight,
+                "clients": _inbound_client_count(inbound),
+                "total_traffic": total,
+            })
+
+    # Триальный клиент создаётся с flow xtls-rprx-vision, поэтому предпочитаем vless
+    vless = [c for c in candidates if c["inbound"].get("protocol") == "vless"]
+    if vless:
+        candidates = vless
+
+    # Трафик за период между выборами сравним, только если есть прошлый замер у всех кандидатов
+    keys = [(c["node"], c["inbound"]["id"]) for c in candidates]
+    use_delta = all(k in _traffic_samples for k in keys)
+    for key, c in zip(keys, candidates):
+        previous = _traffic_samples.get(key)
+        c["traffic"] = max(c["total_traffic"] - previous, 0) if use_delta else c["total_traffic"]
+        _traffic_samples[key] = c["total_traffic"]
+    return candidates
+
+async def choose_inbound(policy: Optional[str] = None) -> Optional[tuple[str, dict]]:
+    """Выбирает (узел, inbound) для нового клиента по политике размещения"""
+    name = policy or PLACEMENT_POLICY
+    score = PLACEMENT_POLICIES.get(name)
+    if score is None:
+        logger.warning(f"⚠️ Неизвестная политика размещения {name}, используем count")
+        name, score = "count", _score_by_count
+
+    candidates = await _placement_candidates()
+    if not candidates:
+        logger.error("❌ Нет доступных inbound для размещения клиента")
+        return None
+
+    best = min(candidates, key=score)
+    summary = ", ".join(
+        f"{c['node']}/{c['inbound']['id']}: клиентов={c['clients']} трафик={c['traffic']} вес={c['weight']:g}"
+        for c in candidates
+    )
+    logger.info(f"📍 Размещение ({name}): выбран {best['node']}/{best['inbound']['id']} из [{summary}]")
+    return best["node"], best["inbound"]
@@ -0,0 +1,282 @@
+# bot/broadcast.py
+import os
+import logging
+import time
+import asyncio
+import sqlite3
+from datetime import datetime
+from typing import Iterable, Optional
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from bot.jobs import cancelled_by_user, job_runner, JobQueueFull
+from bot.metrics import MESSAGES_SENT, track_task
+from bot.state import run_state
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и 1 сообщение в секунду в один чат
+TELEGRAM_RATE = float(os.getenv("TELEGRAM_RATE", "25"))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "3"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "10"))
+# Как часто обновлять сообщение с прогрессом и сохранять результаты в базу
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "3"))
+
+
+class TokenBucket:
+    """Ограничитель скорости; pause() останавливает выдачу токенов всем, например после 429"""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # После паузы начинаем с пустого ведра, без залпа накопленных токенов
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChatThrottle:
+    """Минимальный интервал между сообщениями в один и тот же чат"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._last: dict[int, float] = {}
+
+    async def wait(self, chat_id: int):
+        last = self._last.get(chat_id)
+        if last is not None:
+            delay = self.interval - (time.monotonic() - last)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self._last[chat_id] = time.monotonic()
+
+
+# Общий лимит на бота: его делят рассылки, уведомления и другие массовые отправки
+telegram_bucket = TokenBucket(TELEGRAM_RATE)
+
+
+async def send_with_limits(bot: Bot, chat_id: int, throttle: Optional[ChatThrottle] = None,
+                           **kwargs) -> tuple[str, Optional[str]]:
+    """Отправляет сообщение с учётом лимитов; возвращает (delivered | blocked | failed, ошибка)"""
+    error = None
+    for _ in range(SEND_MAX_ATTEMPTS):
+        if throttle:
+            await throttle.wait(chat_id)
+        await telegram_bucket.acquire()
+        try:
+            await bot.send_message(chat_id, **kwargs)
+            return "delivered", None
+        except TelegramRetryAfter as e:
+            # 429: ждут все отправители, а не только этот
+            telegram_bucket.pause(e.retry_after)
+            error = str(e)
+        except TelegramForbiddenError as e:
+            return "blocked", str(e)
+        except TelegramBadRequest as e:
+            return "failed", str(e)
+        except Exception as e:
+            error = str(e)
+    return "failed", error
+
+
+# Таблицы broadcasts и broadcast_recipients создаются миграциями в bot/state.py
+def _create_broadcast(conn: sqlite3.Connection, admin_chat_id: int, text: str, tg_ids: list[int]) -> int:
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO broadcasts (admin_chat_id, text, created_at) VALUES (?, ?, ?)",
+        (admin_chat_id, text, datetime.now().strftime("%Y-%m-%d %H:%M"))
+    )
+    broadcast_id = cursor.lastrowid
+    cursor.executemany(
+        "INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, tg_id) VALUES (?, ?)",
+        [(broadcast_id, tg_id) for tg_id in tg_ids]
+    )
+    conn.commit()
+    return broadcast_id
+
+
+async def create_broadcast(admin_chat_id: int, text: str, tg_ids: Iterable[int]) -> int:
+    return await run_state(_create_broadcast, admin_chat_id, text, list(tg_ids))
+
+
+async def get_unfinished_broadcasts() -> list[tuple[int, int]]:
+    """(id рассылки, чат администратора) для прерванных рассылок"""
+    rows = await run_state(
+        lambda conn: conn.execute(
+            "SELECT id, admin_chat_id FROM broadcasts WHERE status = 'running' ORDER BY id"
+        ).fetchall()
+    )
+    return [tuple(row) for row in rows]
+
+
+def _write_results(conn: sqlite3.Connection, results: list[tuple]):
+    conn.executemany(
+        "UPDATE broadcast_recipients SET status = ?, error = ? WHERE broadcast_id = ? AND tg_id = ?",
+        results
+    )
+    conn.commit()
+
+
+async def _save_results(results: list[tuple]):
+    if not results:
+        return
+    # Копия: пока идёт запись, воркеры продолжают добавлять в results
+    batch = list(results)
+    results.clear()
+    await run_state(_write_results, batch)
+
+
+def _finish_broadcast(conn: sqlite3.Connection, broadcast_id: int, status: str = "done"):
+    conn.execute(
+        "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?",
+        (status, datetime.now().strftime("%Y-%m-%d %H:%M"), broadcast_id)
+    )
+    conn.commit()
+
+
+def _load_broadcast(conn: sqlite3.Connection, broadcast_id: int) -> Optional[tuple]:
+    row = conn.execute("SELECT admin_chat_id, text FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    if not row:
+        return None
+    counts = {"pending": 0, "delivered": 0, "blocked": 0, "failed": 0}
+    for status, count in conn.execute(
+        "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status",
+        (broadcast_id,)
+    ):
+        counts[status] = count
+    pending = [r[0] for r in conn.execute(
+        "SELECT tg_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'pending'",
+        (broadcast_id,)
+    )]
+    return row[0], row[1], counts, pending
+
+
+def _progress_text(broadcast_id: int, counts: dict, finished: bool = False) -> str:
+    total = sum(counts.values())
+    done = total - counts["pending"]
+    title = "✅ Рассылка завершена" if finished else "📣 Рассылка идёт"
+    return (
+        f"{title} #{broadcast_id}: {done}/{total}\n"
+        f"✅ Доставлено: {counts['delivered']}\n"
+        f"🚫 Заблокировали бота: {counts['blocked']}\n"
+        f"❌ Ошибки: {counts['failed']}"
+    )
+
+
+async def run_broadcast(bot: Bot, broadcast_id: int):
+    """Отправляет всем, кому рассылка ещё не ушла; после перезапуска продолжает с того же места"""
+    with track_task("broadcast"):
+        try:
+            await _run_broadcast(bot, broadcast_id)
+        except asyncio.CancelledError:
+            # /cancel — окончательно; при остановке бота статус остаётся running и рассылка продолжится
+            if cancelled_by_user():
+                await run_state(_finish_broadcast, broadcast_id, "cancelled")
+                logger.info(f"🛑 Рассылка #{broadcast_id} отменена администратором")
+            raise
+
+
+async def _run_broadcast(bot: Bot, broadcast_id: int):
+    loaded = await run_state(_load_broadcast, broadcast_id)
+    if not loaded:
+        logger.error(f"❌ Рассылка #{broadcast_id} не найдена")
+        return
+    admin_chat_id, text, counts, pending = loaded
+
+    logger.info(f"📣 Рассылка #{broadcast_id}: осталось {len(pending)} из {sum(counts.values())}")
+    progress = await bot.send_message(admin_chat_id, _progress_text(broadcast_id, counts))
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for tg_id in pending:
+        queue.put_nowait(tg_id)
+    throttle = ChatThrottle(TELEGRAM_CHAT_INTERVAL)
+    results: list[tuple] = []
+
+    async def worker():
+        while not queue.empty():
+            tg_id = queue.get_nowait()
+            status, error = await send_with_limits(bot, tg_id, throttle, text=text)
+            if status != "delivered":
+                logger.error(f"❌ Не удалось отправить {tg_id}: {error}", extra={"sample": "broadcast_send"})
+            MESSAGES_SENT.inc(source="broadcast", status=status)
+            counts["pending"] -= 1
+            counts[status] += 1
+            results.append((status, error, broadcast_id, tg_id))
+
+    async def report():
+        last_text = None
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await _save_results(results)
+            text_now = _progress_text(broadcast_id, counts)
+            if text_now != last_text:
+                try:
+                    await progress.edit_text(text_now)
+                    last_text = text_now
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось обновить прогресс: {e}")
+
+    reporter = asyncio.create_task(report())
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, min(BROADCAST_WORKERS, len(pending))))))
+    finally:
+        reporter.cancel()
+        # Сохраняем то, что успели отправить, — при перезапуске эти сообщения не уйдут повторно
+        await _save_results(results)
+
+    await run_state(_finish_broadcast, broadcast_id)
+    final_text = _progress_text(broadcast_id, counts, finished=True)
+    try:
+        await progress.edit_text(final_text)
+    except Exception:
+        await bot.send_message(admin_chat_id, final_text)
+    logger.info(f"✅ Рассылка #{broadcast_id} завершена: {counts}")
+
+
+async def start_broadcast(bot: Bot, admin_chat_id: int, text: str, tg_ids: Iterable[int]):
+    broadcast_id = await create_broadcast(admin_chat_id, text, tg_ids)
+    await run_broadcast(bot, broadcast_id)
+
+
+async def resume_broadcasts(bot: Bot):
+    """Ставит прерванные рассылки в job_runner — как и новые, они видны в /jobs и отменяются через /cancel"""
+    by_admin: dict[int, list[int]] = {}
+    for broadcast_id, admin_chat_id in await get_unfinished_broadcasts():
+        by_admin.setdefault(admin_chat_id, []).append(broadcast_id)
+
+    # У job_runner одна задача на (тип, пользователь) — рассылки одного администратора идут по очереди
+    for admin_chat_id, broadcast_ids in by_admin.items():
+        async def run(broadcast_ids=broadcast_ids):
+            for broadcast_id in broadcast_ids:
+                logger.info(f"🔁 Возобновляем рассылку #{broadcast_id}")
+                try:
+                    await run_broadcast(bot, broadcast_id)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка при возобновлении рассылки #{broadcast_id}: {e}")
+
+        try:
+            job, _ = job_runner.submit("broadcast", admin_chat_id, run)
+        except JobQueueFull:
+            logger.warning(f"⚠️ Очередь задач заполнена, рассылки {broadcast_ids} продолжатся после перезапуска")
+            continue
+        logger.info(f"🔁 Рассылки {broadcast_ids} поставлены в очередь (задача #{job.id})")
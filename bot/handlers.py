@@ -1,30 +1,31 @@
 import os
 import aiohttp
-import uuid
-import asyncio
 import time
+from typing import Any, Awaitable, Callable, Optional
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice, PreCheckoutQuery, ShippingOption, ContentType
 from aiogram.enums import ContentType
 from aiogram.filters import Command, CommandObject, CommandStart
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from dateutil.relativedelta import relativedelta
-from bot.referrals import export_to_gsheet
 from bot.sync import sync_to_google_sheets
 from bot import referrals
-from bot.api import find_user_by_tg, add_trial_user, get_inbounds, update_user_expiry, get_all_clients
+from bot.broadcast import start_broadcast
+from bot.usernames import resolve_usernames
+from bot.api import (
+    find_user_by_tg, add_trial_user, choose_inbound, get_all_clients, get_scheduler_stats, panel_priority, BACKGROUND
+)
 from bot.utils import generate_uuid, generate_sub_id, generate_email, generate_expiry, get_expiry_datetime, is_admin, load_terms_text
-from yookassa import Configuration, Payment
+from bot.jobs import job_runner, JobQueueFull
+from bot.scheduler import get_schedule_info
+from bot.payments import create_sbp_payment, track_payment, record_payment, apply_payment
 
 router = Router()
-active_payments = {}
 
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_ID", "").split(",") if x.strip()]
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
 SUB_LINK_TEMPLATE = os.getenv("SUB_LINK_TEMPLATE")
-Configuration.account_id = os.getenv("YOOKASSA_SHOP_ID")
-Configuration.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
+STALE_NOTE = "\n\n⚠️ Сервер временно недоступен, данные могут быть неактуальны."
 
 @router.message(CommandStart())
 async def start_handler(message: Message, command: CommandObject):
@@ -34,10 +35,10 @@ async def start_handler(message: Message, command: CommandObject):
 
     if not user and command.args and command.args.startswith("ref_"):
         ref_code = command.args.replace("ref_", "")
-        inviter_tg_id = referrals.get_inviter_by_code(ref_code)
+        inviter_tg_id = await referrals.get_inviter_by_code(ref_code)
 
         if inviter_tg_id and inviter_tg_id != tg_id:
-            referrals.save_referral(inviter_tg_id, tg_id, ref_code)
+            await referrals.save_referral(inviter_tg_id, tg_id, ref_code)
 
     reply_buttons = [
         [InlineKeyboardButton(text="🔎 Проверить статус", callback_data="check_status")],
@@ -66,7 +67,8 @@ async def start_handler(message: Message, command: CommandObject):
                 "👋 Добро пожаловать!\n"
                 f"❌ Ваша подписка истекла <b>{expiry_str}</b>\n\n"
                 f"🔗 Ваша ссылка на подключение:\n<code>{sub_link}</code>\n\n"
-                "💳 Чтобы снова получить доступ, выберите срок продления подписки:",
+                "💳 Чтобы снова получить доступ, выберите срок продления подписки:"
+                + (STALE_NOTE if user.get("stale") else ""),
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=reply_buttons),
                 parse_mode="HTML"
             )
@@ -75,7 +77,8 @@ async def start_handler(message: Message, command: CommandObject):
                 "👋 Добро пожаловать!\n"
                 f"📅 Ваша подписка активна до: <b>{expiry_str}</b>\n"
                 f"🔗 Ваша ссылка для подключения:\n<code>{sub_link}</code>\n\n"
-                "⏰ Я напомню о необходимости продления за день до окончания срока действия подписки.",
+                "⏰ Я напомню о необходимости продления за день до окончания срока действия подписки."
+                + (STALE_NOTE if user.get("stale") else ""),
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=reply_buttons),
                 parse_mode="HTML"
             )
@@ -99,14 +102,14 @@ async def start_handler(message: Message, command: CommandObject):
 @router.callback_query(F.data == "get_trial")
 async def handle_get_trial(callback: CallbackQuery):
     tg_id = callback.from_user.id
-    inbounds = await get_inbounds()
-    if not inbounds:
+    placement = await choose_inbound()
+    if not placement:
         await callback.answer("❌ Не удалось получить информацию. Попробуйте позже.", show_alert=True)
         return
 
-    inbound = inbounds[0]
+    node, inbound = placement
 
-    success, sub_id, expiry_ms = await add_trial_user(inbound["id"], tg_id)
+    success, sub_id, expiry_ms = await add_trial_user(inbound["id"], tg_id, node=node)
     if not success:
         await callback.answer("❌ Не удалось создать пробную учетную запись.", show_alert=True)
         return
@@ -158,7 +161,8 @@ async def handle_check_status(callback: CallbackQuery):
             await callback.message.answer(
                 "❌ Статус подписки: <b>Истекла</b>\n"
                 f"📅 Дата окончания: <b>{expiry_str}</b>\n\n"
-                "Чтобы продлить подписку, выберите один из вариантов ниже.",
+                "Чтобы продлить подписку, выберите один из вариантов ниже."
+                + (STALE_NOTE if user.get("stale") else ""),
                 reply_markup=InlineKeyboardMarkup(
                     inline_keyboard=[
                         [InlineKeyboardButton(text="🔁 Продлить подписку", callback_data="renew_subscription")],
@@ -170,7 +174,8 @@ async def handle_check_status(callback: CallbackQuery):
             await callback.message.answer(
                 "🔎 Статус подписки: <b>Активна</b>\n"
                 f"📅 Дата окончания: <b>{expiry_str}</b>\n\n"
-                "❗ Я напомню о необходимости продления за день до окончания подписки.",
+                "❗ Я напомню о необходимости продления за день до окончания подписки."
+                + (STALE_NOTE if user.get("stale") else ""),
                 reply_markup=InlineKeyboardMarkup(
                     inline_keyboard=[
                         [InlineKeyboardButton(text="🔁 Продлить подписку", callback_data="renew_subscription")],
@@ -261,97 +266,8 @@ async def handle_sbp_payment(callback: CallbackQuery):
         )
     )
 
-    await poll_payment_status(callback, user, prices[plan], payment_id)
-
-# --- Создание платежа через API ЮKassa ---
-async def create_sbp_payment(tg_id: int, plan: str, price_info: dict):
-
-    old_payment_id = active_payments.get(tg_id)
-    if old_payment_id:
-        try:
-            payment = Payment.find_one(old_payment_id)
-            if payment.status in ["pending", "waiting_for_capture"]:
-                print(f"[sbp] Повторный вызов платежа {old_payment_id}")
-                return payment.confirmation.confirmation_url, old_payment_id
-        except Exception as e:
-            print(f"[sbp] Ошибка при проверке старого платежа: {e}")
-
-    receipt = {
-        "customer": {
-            "full_name": f"User {tg_id}",
-            "email": f"user{tg_id}@null.core"  # или любой другой технический домен
-        },
-        "items": [
-            {
-                "description": f"Подписка на {price_info['label']}",
-                "quantity": 1.0,
-                "amount": {"value": price_info["value"], "currency": "RUB"},
-                "vat_code": 1
-            }
-        ]
-    }
-
-    try:
-        new_payment = Payment.create({
-            "amount": {"value": price_info["value"], "currency": "RUB"},
-            "payment_method_data": {"type": "sbp"},
-            "confirmation": {"type": "redirect", "return_url": "https://t.me/nullcorevpn_bot"},
-            "capture": True,
-            "description": f"Подписка на {price_info['label']}",
-            "metadata": {"tg_id": str(tg_id), "plan": plan},
-            "receipt": receipt
-        }, uuid.uuid4().hex)
-
-        # Сохраняем активный payment_id
-        active_payments[tg_id] = new_payment.id
-
-        return new_payment.confirmation.confirmation_url, new_payment.id
-
-    except Exception as e:
-        print("[sbp] Ошибка создания платежа:", e)
-        return None, None
-
-# --- Polling статуса ---
-async def poll_payment_status(callback: CallbackQuery, user: dict, price_info: dict, payment_id: str):
-    max_attempts = 60
-    for attempt in range(max_attempts):
-        payment = Payment.find_one(payment_id)
-        if payment.status == "succeeded":
-            months = price_info["months"]
-            now = datetime.now(ZoneInfo("Europe/Moscow"))
-            expiry_now = get_expiry_datetime(user["expiryTime"])
-            if not expiry_now or expiry_now < now:
-                expiry_now = now
-
-            base_date = expiry_now.replace(hour=0, minute=0, second=0, microsecond=0)
-            new_expiry = base_date + relativedelta(months=+months)
-            new_expiry = new_expiry.replace(hour=23, minute=59, second=59, microsecond=0)
-
-            success = await update_user_expiry(
-                user["inbound_id"],
-                user["client"]["id"],
-                int(new_expiry.astimezone(timezone.utc).timestamp() * 1000)
-            )
-
-            # Удаляем активный платёж
-            active_payments.pop(callback.from_user.id, None)
-
-            if success:
-                referrals.mark_as_paid(callback.from_user.id)
-                await callback.message.answer(
-                    f"✅ Подписка продлена до <b>{new_expiry.strftime('%d.%m.%Y %H:%M')}</b>"
-                )
-            else:
-                await callback.message.answer(
-                    "❌ Не удалось продлить подписку после оплаты. Обратитесь к администратору.")
-            return
-
-        elif payment.status in ["canceled", "waiting_for_capture"]:
-            active_payments.pop(callback.from_user.id, None)
-
-        await asyncio.sleep(5)
-
-    await callback.message.answer("⏳ Время ожидания истекло. Оплата не подтверждена.")
+    # Статус платежа отслеживает сверщик в bot.payments — обработчик не ждёт оплаты
+    await track_payment(payment_id, callback.from_user.id, callback.message.chat.id, plan, prices[plan]["months"])
 
 @router.callback_query(F.data.startswith("buy_"))
 async def handle_buy_subscription(callback: CallbackQuery):
@@ -403,31 +319,10 @@ async def successful_payment_handler(message: Message):
         await message.answer("⚠️ Неизвестный тариф.")
         return
 
-    user = await find_user_by_tg(tg_id)
-    if not user:
-        await message.answer("⚠️ Пользователь не найден.")
-        return
-
-    expiry_now = get_expiry_datetime(user["expiryTime"])
-    now = datetime.now(ZoneInfo("Europe/Moscow"))
-    if not expiry_now or expiry_now < now:
-        expiry_now = now
-
-    base_date = expiry_now.replace(hour=0, minute=0, second=0, microsecond=0)
-    new_expiry = base_date + relativedelta(months=+months)
-    new_expiry = new_expiry.replace(hour=23, minute=59, second=59, microsecond=0)
-
-    success = await update_user_expiry(
-        user["inbound_id"],
-        user["client"]["id"],
-        int(new_expiry.astimezone(timezone.utc).timestamp() * 1000)
-    )
-
-    if success:
-        referrals.mark_as_paid(message.from_user.id)
-        await message.answer(f"✅ Подписка продлена до <b>{new_expiry.strftime('%d.%m.%Y %H:%M')}</b>")
-    else:
-        await message.answer("❌ Не удалось продлить подписку. Обратитесь к администратору.")
+    # Платёж идёт через журнал: повторная доставка того же апдейта не продлит подписку второй раз
+    charge_id = message.successful_payment.telegram_payment_charge_id
+    await record_payment(charge_id, "telegram", tg_id, message.chat.id, plan, months, status="succeeded")
+    await apply_payment(message.bot, charge_id)
 
 # Рассылка сообщений пользователям
 @router.message(Command("broadcast"))
@@ -441,27 +336,91 @@ async def handle_broadcast(message: Message, command: CommandObject):
         await message.answer("❗ Используйте: /broadcast [сообщение]", parse_mode="HTML")
         return
 
-    # Получаем всех пользователей
-    clients = await get_all_clients()
-    count = 0
-    for client in clients:
-        tg_id = client.get("tgId")
-        if not tg_id:
-            continue
-        try:
-            await message.bot.send_message(tg_id, text)
-            count += 1
-        except Exception as e:
-            print(f"[broadcast] ❌ Не удалось отправить {tg_id}: {e}")
+    async def run():
+        # Получаем всех пользователей; один tgId может быть у нескольких клиентов
+        with panel_priority(BACKGROUND):
+            clients = await get_all_clients()
+        tg_ids = set()
+        for client in clients:
+            if not client.get("tgId"):
+                continue
+            try:
+                tg_ids.add(int(client["tgId"]))
+            except (TypeError, ValueError):
+                continue
+
+        await start_broadcast(message.bot, message.chat.id, text, tg_ids)
 
-    await message.answer(f"✅ Сообщение отправлено {count} пользователям.")
+    await submit_job(message, "broadcast", message.from_user.id, run, "📣 Рассылка")
 
 #google sheets
 @router.message(Command("sync"))
 async def sync_command(message: Message, bot: Bot):
-    await sync_to_google_sheets(bot)
-    export_to_gsheet()
-    await message.answer("✅ Синхронизация таблицы завершена.")
+    async def run():
+        # Реферальная таблица выгружается внутри sync_to_google_sheets
+        await sync_to_google_sheets(bot)
+        await message.answer("✅ Синхронизация таблицы завершена.")
+
+    # Синхронизация одна на весь бот, сколько бы раз ни нажали /sync
+    await submit_job(message, "sync", None, run, "🔄 Синхронизация")
+
+# Фоновые задачи
+async def submit_job(message: Message, job_type: str, user_id: Optional[int],
+                     factory: Callable[[], Awaitable[Any]], title: str):
+    try:
+        job, created = job_runner.submit(job_type, user_id, factory)
+    except JobQueueFull:
+        await message.answer("⏳ Сейчас слишком много задач, попробуйте позже.")
+        return
+    if created:
+        await message.answer(f"{title} запущена (задача #{job.id}).")
+    else:
+        await message.answer(f"{title} уже выполняется (задача #{job.id}).")
+
+@router.message(Command("jobs"))
+async def jobs_command(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔ У вас нет прав.")
+        return
+
+    stats = job_runner.stats()
+    lines = [f"🧵 В очереди: {stats['queued']}, выполняется: {stats['running']}"]
+    for job in job_runner.active_jobs():
+        duration = f", {job.duration:.0f} с" if job.duration is not None else ""
+        lines.append(f"#{job.id} {job.type} — {job.status}{duration}")
+    for job_type, d in stats["durations"].items():
+        lines.append(f"⏱ {job_type}: {d['count']} запусков, в среднем {d['avg']:.1f} с, максимум {d['max']:.1f} с")
+    panel = get_scheduler_stats()
+    lines.append(f"🌐 Запросы к панели: выполняется {panel['active']}, ждут слота {panel['queued']}")
+    for priority, wait in panel["wait"].items():
+        if wait["count"]:
+            lines.append(
+                f"⏳ Ожидание слота ({priority}): {wait['count']} запросов, "
+                f"в среднем {wait['avg'] * 1000:.0f} мс, максимум {wait['max'] * 1000:.0f} мс"
+            )
+    for schedule in await get_schedule_info():
+        line = f"🗓 {schedule['name']} ({schedule['spec']})"
+        if schedule["next_run"]:
+            line += f": следующий запуск {schedule['next_run']:%d.%m %H:%M} МСК"
+        if schedule["last"]:
+            last = schedule["last"]
+            line += f", последний — {last['status']} за {last['duration']:.1f} с"
+        lines.append(line)
+    await message.answer("\n".join(lines))
+
+@router.message(Command("cancel"))
+async def cancel_command(message: Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔ У вас нет прав.")
+        return
+
+    if not command.args or not command.args.strip().isdigit():
+        await message.answer("❗ Используйте: /cancel [номер задачи]")
+        return
+    if job_runner.cancel(int(command.args)):
+        await message.answer(f"🛑 Задача #{command.args.strip()} отменена.")
+    else:
+        await message.answer("🤷 Активной задачи с таким номером нет.")
 
 #refferal-system
 @router.callback_query(F.data == "ref_menu")
@@ -482,20 +441,19 @@ async def handle_ref_link(callback: CallbackQuery):
 
 @router.callback_query(F.data == "my_referrals")
 async def handle_my_referrals(callback: CallbackQuery, bot: Bot):
-    referrals_list = referrals.get_referrals_by_inviter(callback.from_user.id)
+    referrals_list = await referrals.get_referrals_by_inviter(callback.from_user.id)
 
     await callback.answer()
     if not referrals_list:
         await callback.message.answer("🤷 У вас пока нет приглашённых. Они появятся после первой оплаты.")
         return
 
+    usernames = await resolve_usernames(bot, (item["tg_id"] for item in referrals_list))
+
     text = "👥 Ваши приглашённые:\n\n"
     for item in referrals_list:
-        try:
-            user = await bot.get_chat(int(item["tg_id"]))
-            username = f"@{user.username}" if user.username else f"<code>{item['tg_id']}</code>"
-        except Exception:
-            username = f"<code>{item['tg_id']}</code>"
+        username = usernames.get(int(item["tg_id"]))
+        username = f"@{username}" if username else f"<code>{item['tg_id']}</code>"
 
         try:
             formatted_date = datetime.strptime(item["date"], "%Y-%m-%d %H:%M").strftime("%d.%m.%Y")
@@ -0,0 +1,186 @@
+# bot/jobs.py
+import os
+import logging
+import time
+import asyncio
+import itertools
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional
+from dotenv import load_dotenv
+from bot.metrics import Gauge
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Долгие операции (синхронизация, рассылка) выполняются здесь, а не внутри обработчиков апдейтов
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+# Сколько завершённых задач и длительностей хранить для /jobs
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "50"))
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id: int, job_type: str, user_id: Optional[int], factory: Callable[[], Awaitable[Any]]):
+        self.id = job_id
+        self.type = job_type
+        self.user_id = user_id
+        self.factory = factory
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.created_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        # True — отменил администратор через /cancel; при остановке бота остаётся False
+        self.cancel_requested = False
+
+    @property
+    def key(self) -> tuple:
+        return self.type, self.user_id
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+
+# Задача job_runner, внутри которой выполняется код; копируется в контекст её asyncio-задачи
+current_job: ContextVar[Optional[Job]] = ContextVar("current_job", default=None)
+
+
+def cancelled_by_user() -> bool:
+    """Отменена ли текущая задача администратором, а не остановкой бота"""
+    job = current_job.get()
+    return bool(job and job.cancel_requested)
+
+
+class JobRunner:
+    """Очередь задач с ограниченным пулом воркеров; одна активная задача на (тип, пользователь)"""
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._ids = itertools.count(1)
+        self._active: Dict[tuple, Job] = {}
+        self._history: deque = deque(maxlen=JOB_HISTORY)
+        self._durations: Dict[str, deque] = {}
+        self._worker_tasks: list[asyncio.Task] = []
+
+    def start(self):
+        if not self._worker_tasks:
+            self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Не через cancel(): прерванные остановкой задачи (например, рассылки) продолжатся после запуска
+        for job in list(self._active.values()):
+            self._cancel(job)
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def submit(self, job_type: str, user_id: Optional[int],
+               factory: Callable[[], Awaitable[Any]]) -> tuple[Job, bool]:
+        """Ставит задачу в очередь; если такая уже ждёт или выполняется — возвращает её и False"""
+        existing = self._active.get((job_type, user_id))
+        if existing:
+            return existing, False
+        job = Job(next(self._ids), job_type, user_id, factory)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFull(f"Очередь задач заполнена ({self._queue.maxsize})")
+        self._active[job.key] = job
+        logger.info(f"Задача #{job.id} {job_type} поставлена в очередь")
+        return job, True
+
+    def get(self, job_id: int) -> Optional[Job]:
+        for job in itertools.chain(self._active.values(), self._history):
+            if job.id == job_id:
+                return job
+        return None
+
+    def cancel(self, job_id: int) -> bool:
+        """Отмена администратором"""
+        job = next((j for j in self._active.values() if j.id == job_id), None)
+        if not job:
+            return False
+        job.cancel_requested = True
+        self._cancel(job)
+        return True
+
+    def _cancel(self, job: Job):
+        if job.task:
+            job.task.cancel()
+        else:
+            # Ещё в очереди: воркер пропустит её
+            self._finish(job, "cancelled")
+
+    def _finish(self, job: Job, status: str, error: Optional[str] = None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.monotonic()
+        self._active.pop(job.key, None)
+        self._history.append(job)
+        if job.started_at is not None:
+            self._durations.setdefault(job.type, deque(maxlen=JOB_HISTORY)).append(job.duration)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.status != "queued":
+                    continue
+                job.status = "running"
+                job.started_at = time.monotonic()
+                token = current_job.set(job)
+                job.task = asyncio.create_task(job.factory())
+                current_job.reset(token)
+                try:
+                    await job.task
+                    self._finish(job, "done")
+                except asyncio.CancelledError:
+                    self._finish(job, "cancelled")
+                    # Отменили сам воркер, а не задачу, — выходим
+                    if asyncio.current_task().cancelling():
+                        raise
+                except Exception as e:
+                    self._finish(job, "failed", f"{type(e).__name__}: {e}")
+                    logger.error(f"❌ Задача #{job.id} {job.type} завершилась ошибкой: {job.error}")
+                else:
+                    logger.info(f"✅ Задача #{job.id} {job.type} выполнена за {job.duration:.1f} с")
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        durations = {
+            job_type: {
+                "count": len(values),
+                "avg": sum(values) / len(values),
+                "max": max(values)
+            }
+            for job_type, values in self._durations.items() if values
+        }
+        return {
+            "queued": sum(1 for job in self._active.values() if job.status == "queued"),
+            "running": sum(1 for job in self._active.values() if job.status == "running"),
+            "durations": durations
+        }
+
+    def active_jobs(self) -> list[Job]:
+        return sorted(self._active.values(), key=lambda job: job.id)
+
+
+job_runner = JobRunner(JOB_WORKERS, JOB_QUEUE_SIZE)
+
+JOBS_ACTIVE = Gauge(
+    "bot_jobs", "Задачи в очереди и в работе", ("state",),
+    callback=lambda: {(state,): job_runner.stats()[state] for state in ("queued", "running")}
+)
@@ -0,0 +1,148 @@
+# bot/log.py
+import os
+import re
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Модули пишут в logging.getLogger(__name__); форматирование и вывод — в потоке QueueListener, не в event loop
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json — по строке JSON на запись; text — для чтения глазами при локальной отладке
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Частые сообщения одного вида (extra={"sample": ...}): первые LOG_SAMPLE_BURST за окно, дальше каждое LOG_SAMPLE_EVERY-е
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "10"))
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))
+LOG_SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", "60"))
+
+# Переменные окружения, значения которых не должны попасть в логи
+SECRET_ENV = ("BOT_TOKEN", "XUI_PASSWORD", "YOOKASSA_SECRET_KEY", "WEBHOOK_SECRET", "PAYMENT_PROVIDER_TOKEN")
+# Токен бота в любом виде, в том числе в URL запросов к api.telegram.org
+TOKEN_RE = re.compile(r"\b\d{6,12}:[A-Za-z0-9_-]{30,}")
+REDACTED = "***"
+
+# Поля LogRecord, которые не считаются пользовательскими extra
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_listener: Optional[QueueListener] = None
+
+
+def _collect_secrets() -> list[str]:
+    secrets = [os.getenv(name) for name in SECRET_ENV]
+    panels = os.getenv("XUI_PANELS")
+    if panels:
+        try:
+            secrets += [item.get("password") for item in json.loads(panels)]
+        except (ValueError, AttributeError):
+            pass
+    # Длинные значения первыми, чтобы не оставить хвост более длинного секрета
+    return sorted({s for s in secrets if s and len(s) >= 4}, key=len, reverse=True)
+
+
+class RedactFilter(logging.Filter):
+    """Заменяет секреты в тексте записи и трейсбеке на ***"""
+
+    def __init__(self, secrets: list[str]):
+        super().__init__()
+        self.secrets = secrets
+
+    def redact(self, text: str) -> str:
+        for secret in self.secrets:
+            text = text.replace(secret, REDACTED)
+        return TOKEN_RE.sub(REDACTED, text)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = self.redact(record.getMessage())
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        if record.exc_text:
+            record.exc_text = self.redact(record.exc_text)
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Прореживает записи с extra={"sample": ключ}; пропущенная запись получает suppressed — сколько отброшено перед ней"""
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._counts: dict[str, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is None or now - entry[0] >= LOG_SAMPLE_WINDOW:
+                entry = self._counts[key] = [now, 0]
+            entry[1] += 1
+            count = entry[1]
+        if count <= LOG_SAMPLE_BURST:
+            return True
+        if (count - LOG_SAMPLE_BURST) % LOG_SAMPLE_EVERY == 0:
+            record.suppressed = LOG_SAMPLE_EVERY - 1
+            return True
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RESERVED})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _LocalQueueHandler(QueueHandler):
+    """Очередь внутри процесса: запись не копируется и не форматируется, в вызывающем потоке только подставляются аргументы"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging():
+    """Настраивает корневой логгер; вызывается один раз при запуске бота"""
+    global _listener
+    if _listener:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.addFilter(RedactFilter(_collect_secrets()))
+    if LOG_FORMAT == "text":
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    else:
+        output.setFormatter(JsonFormatter())
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = _LocalQueueHandler(log_queue)
+    # Прореживание — до очереди, чтобы отброшенные записи не нагружали поток вывода
+    handler.addFilter(SampleFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
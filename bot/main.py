@@ -1,7 +1,7 @@
 import asyncio
 import os
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
+import signal
+import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
@@ -9,25 +9,43 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand
 from dotenv import load_dotenv
 from bot.handlers import router
-from bot.notifier import notify_users
-from bot.api import test_api_connection
-from bot.sync import sync_to_google_sheets
+from bot.notifier import resume_interrupted_run
+from bot.api import test_api_connection, close_panel
+from bot.scheduler import run_scheduler
+from bot.broadcast import resume_broadcasts
+from bot.referrals import init_db, close_db
+from bot.state import init_state_db, close_state_db
+from bot.payments import reconcile_payments
+from bot.web import start_web_server, start_metrics_server, WEBHOOK_PATH, WEBHOOK_SECRET
+from bot.jobs import job_runner
+from bot.metrics import LOOP_LAG, MetricsMiddleware
+from bot.utils import LoopLagMonitor
+from bot.log import setup_logging
 
 # Загрузка переменных из .env
 load_dotenv()
+setup_logging()
+
+logger = logging.getLogger(__name__)
 
 TOKEN = os.getenv("BOT_TOKEN")
 XUI_API_URL = os.getenv("XUI_API_URL")
 XUI_USERNAME = os.getenv("XUI_USERNAME")
 XUI_PASSWORD = os.getenv("XUI_PASSWORD")
-
-print("🔧 DEBUG ENV:", TOKEN, XUI_API_URL, XUI_USERNAME)
+XUI_PANELS = os.getenv("XUI_PANELS")
+# polling — long polling; webhook — апдейты приходят на HTTP-сервер из bot/web.py
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес сервера для Telegram; без него вебхук не регистрируется (локальная отладка)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 
 if not TOKEN:
     raise RuntimeError("❌ BOT_TOKEN не задан в .env")
 
-if not all([XUI_API_URL, XUI_USERNAME, XUI_PASSWORD]):
-    raise RuntimeError("❌ Переменные XUI_API_URL, XUI_USERNAME и XUI_PASSWORD должны быть заданы в .env")
+if BOT_MODE not in ("polling", "webhook"):
+    raise RuntimeError("❌ BOT_MODE должен быть polling или webhook")
+
+if not XUI_PANELS and not all([XUI_API_URL, XUI_USERNAME, XUI_PASSWORD]):
+    raise RuntimeError("❌ Задайте XUI_PANELS или переменные XUI_API_URL, XUI_USERNAME и XUI_PASSWORD в .env")
 
 # Инициализация бота с HTML-парсингом
 bot = Bot(
@@ -38,6 +56,9 @@ bot = Bot(
 # Инициализация диспетчера
 dp = Dispatcher(storage=MemoryStorage())
 dp.include_router(router)
+# Время и исход каждого обработчика — для /metrics
+for observer in (router.message, router.callback_query, router.pre_checkout_query):
+    observer.middleware(MetricsMiddleware())
 
 # Установка команд бота
 async def set_commands():
@@ -47,58 +68,74 @@ async def set_commands():
 
 # Проверка API перед стартом
 async def log_api_info():
-    print("\n🛠 [main.py] Проверка подключения к API 3x-ui:")
+    logger.info("🛠 Проверка подключения к API 3x-ui")
     try:
         result = await test_api_connection()
         if result:
-            print(" → ✅ Успешное подключение к API")
+            logger.info("✅ Успешное подключение к API")
         else:
-            print(" → ❌ Не удалось получить список inbounds")
+            logger.error("❌ Не удалось получить список inbounds")
     except Exception as e:
-        print(f" → ❌ Ошибка при обращении к API: {e}")
-
-# Фоновая задача — уведомление пользователей в 18:00 по МСК
-async def periodic_notifications(bot: Bot):
-    while True:
-        now = datetime.now(ZoneInfo("Europe/Moscow"))
-        target = now.replace(hour=18, minute=0, second=0, microsecond=0)
-        if now > target:
-            target += timedelta(days=1)
-
-        wait_seconds = (target - now).total_seconds()
-        print(f"⏳ Ждём до 18:00 по МСК: {wait_seconds / 3600:.2f} ч.")
-        await asyncio.sleep(wait_seconds)
-
-        print("🔔 Запуск уведомлений...")
-        await notify_users(bot)
-
-# Фоновая задача — синхронизация таблицы в 09:00 МСК
-async def sync_scheduler(bot: Bot):
-    while True:
-        now = datetime.now(ZoneInfo("Europe/Moscow"))
-        target = now.replace(hour=9, minute=0, second=0, microsecond=0)
-        if now > target:
-            target += timedelta(days=1)
-
-        wait_seconds = (target - now).total_seconds()
-        print(f"🕘 Ждём до 09:00 МСК для синхронизации: {wait_seconds / 3600:.2f} ч.")
-        await asyncio.sleep(wait_seconds)
-
-        print("🔁 Запуск синхронизации таблицы...")
-        try:
-            await sync_to_google_sheets(bot)
-        except Exception as e:
-            print(f"[SYNC] ❌ Ошибка синхронизации: {e}")
-
+        logger.error(f"❌ Ошибка при обращении к API: {e}")
+
+# Режим вебхука: апдейты принимает HTTP-сервер, здесь только регистрируем адрес и ждём
+async def run_webhook(stop: asyncio.Event):
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"🌐 Вебхук зарегистрирован: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    else:
+        logger.warning(f"⚠️ WEBHOOK_URL не задан — принимаем апдейты на {WEBHOOK_PATH}, но Telegram о нём не знает")
+    await stop.wait()
 
 # Точка входа
 async def main():
-    print("✅ Бот запускается...")
+    logger.info("✅ Бот запускается...")
+    # По SIGTERM (docker compose down) выходим через finally, а не обрываем процесс:
+    # иначе базы не закрываются. В режиме polling сигналы перехватывает сам aiogram
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await init_db()
+    await init_state_db()
     await log_api_info()
     await set_commands()
-    asyncio.create_task(periodic_notifications(bot))
-    asyncio.create_task(sync_scheduler(bot))
-    await dp.start_polling(bot)
+    job_runner.start()
+    # Рассылки, прерванные перезапуском, продолжаются с того же места — задачами job_runner, как и новые
+    await resume_broadcasts(bot)
+    await resume_interrupted_run(bot)
+    payments_task = asyncio.create_task(reconcile_payments(bot))
+    web_runner = await start_web_server(bot, dp if BOT_MODE == "webhook" else None)
+    # Уведомления в 18:00 и синхронизация таблицы в 09:00 по МСК — см. bot/scheduler.py
+    scheduler_task = asyncio.create_task(run_scheduler(bot))
+    metrics_runner = await start_metrics_server()
+    lag_monitor = LoopLagMonitor(0.5, on_lag=LOOP_LAG.observe)
+    lag_monitor.start()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(stop)
+        else:
+            # Пока вебхук зарегистрирован, getUpdates не работает
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        scheduler_task.cancel()
+        # Сверщик платежей пишет в bot.db — останавливаем его до закрытия базы
+        payments_task.cancel()
+        await asyncio.gather(scheduler_task, payments_task, return_exceptions=True)
+        lag_monitor.stop()
+        await job_runner.stop()
+        if web_runner:
+            await web_runner.cleanup()
+        await metrics_runner.cleanup()
+        await close_panel()
+        await close_db()
+        await close_state_db()
+        logger.info("Бот остановлен")
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,196 @@
+# bot/metrics.py
+import time
+import bisect
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+# Метрики в текстовом формате Prometheus; отдаются на /metrics HTTP-сервера из bot/web.py
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TASK_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_registry: list = []
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_format(v)}" for key, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Значение задаётся через set() или читается из callback при каждом запросе /metrics"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 callback: Optional[Callable[[], Dict[tuple, float]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def _samples(self) -> list[str]:
+        values = self.callback() if self.callback else self._values
+        return [f"{self.name}{_labels(self.labelnames, key)} {_format(v)}" for key, v in values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ключ -> [счётчики по корзинам, сумма, количество]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % _format(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            inf = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, inf)} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_format(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HANDLER_DURATION = Histogram(
+    "bot_handler_duration_seconds", "Время обработки апдейта обработчиком", ("handler",)
+)
+HANDLER_CALLS = Counter("bot_handler_calls_total", "Вызовы обработчиков", ("handler", "status"))
+
+PANEL_REQUEST_DURATION = Histogram(
+    "bot_panel_request_duration_seconds", "Длительность HTTP-запроса к панели 3x-ui", ("node", "op")
+)
+PANEL_REQUESTS = Counter("bot_panel_requests_total", "HTTP-запросы к панели по статусу ответа", ("node", "op", "status"))
+PANEL_GATE_WAIT = Histogram(
+    "bot_panel_gate_wait_seconds", "Ожидание слота запроса к панели по приоритету", ("priority",)
+)
+PANEL_RESPONSE_SIZE = Histogram(
+    "bot_panel_response_size_bytes", "Размер ответа панели", ("node", "op"), buckets=SIZE_BUCKETS
+)
+
+TASK_DURATION = Histogram(
+    "bot_task_duration_seconds", "Длительность фоновых задач (уведомления, синхронизация, рассылки)",
+    ("task",), buckets=TASK_BUCKETS
+)
+TASK_RUNS = Counter("bot_task_runs_total", "Запуски фоновых задач", ("task", "status"))
+MESSAGES_SENT = Counter("bot_messages_sent_total", "Массовые отправки сообщений по результату", ("source", "status"))
+
+CACHE_REQUESTS = Counter("bot_cache_requests_total", "Обращения к кэшам: hit, miss или stale", ("cache", "result"))
+
+LOOP_LAG = Histogram("bot_event_loop_lag_seconds", "Задержка event loop относительно ожидаемого пробуждения")
+
+
+@contextmanager
+def track_task(task: str):
+    """Длительность и исход фоновой задачи"""
+    status = "ok"
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        TASK_DURATION.observe(time.monotonic() - start, task=task)
+        TASK_RUNS.inc(task=task, status=status)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware роутера: время и исход каждого обработчика"""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        status = "ok"
+        start = time.monotonic()
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.monotonic() - start, handler=name)
+            HANDLER_CALLS.inc(handler=name, status=status)
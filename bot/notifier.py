@@ -1,61 +1,183 @@
 # bot/notifier.py
 import os
+import logging
+import asyncio
+import sqlite3
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from bot.api import get_all_clients
-from bot.utils import get_expiry_datetime, is_expiring_soon
+from bot.api import get_all_clients, panel_priority, BACKGROUND
+from bot.broadcast import send_with_limits
+from bot.jobs import job_runner, JobQueueFull
+from bot.metrics import MESSAGES_SENT, track_task
+from bot.state import run_state
+from bot.utils import get_expiry_datetime, is_expiring_soon, parse_tg_id
+
+logger = logging.getLogger(__name__)
 
 # Загружаем данные из .env
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
 ADMIN_GREETING_TEXT = os.getenv("ADMIN_GREETING_TEXT")
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "10"))
+# Записи журнала копятся и пишутся пачкой; при падении повторно уйдут не больше этого числа напоминаний
+NOTIFY_LEDGER_BATCH = int(os.getenv("NOTIFY_LEDGER_BATCH", "50"))
+
+MSK = ZoneInfo("Europe/Moscow")
+
+# Клавиатура одинаковая для всех уведомлений — собираем один раз
+RENEW_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="🔁 Продлить подписку", callback_data="renew_subscription")],
+        [InlineKeyboardButton(
+            text="💬 Связаться с админом",
+            url=f"tg://resolve?domain={ADMIN_USERNAME}&text={(ADMIN_GREETING_TEXT or '').replace(' ', '%20')}"
+        )]
+    ]
+)
+
+
+# Журнал доставки: одно напоминание на (пользователь, дата окончания, вид напоминания).
+# Таблицы notify_ledger и notify_runs создаются миграциями в bot/state.py
+def _start_run(conn: sqlite3.Connection, run_date: str, min_expiry_ms: int) -> set[tuple]:
+    """Отмечает начало запуска и возвращает уже обработанные напоминания"""
+    conn.execute(
+        "INSERT OR REPLACE INTO notify_runs (run_date, started_at, finished_at) VALUES (?, ?, NULL)",
+        (run_date, datetime.now(MSK).strftime("%Y-%m-%d %H:%M"))
+    )
+    conn.commit()
+    # failed не считаем обработанным — такие напоминания повторяются при следующем запуске
+    rows = conn.execute(
+        "SELECT tg_id, expiry, kind FROM notify_ledger WHERE status != 'failed' AND expiry >= ?",
+        (min_expiry_ms,)
+    )
+    return {(row[0], row[1], row[2]) for row in rows}
+
+
+def _finish_run(conn: sqlite3.Connection, run_date: str):
+    conn.execute(
+        "UPDATE notify_runs SET finished_at = ? WHERE run_date = ?",
+        (datetime.now(MSK).strftime("%Y-%m-%d %H:%M"), run_date)
+    )
+    conn.commit()
+
+
+def _write_ledger(conn: sqlite3.Connection, rows: list[tuple]):
+    conn.executemany(
+        "INSERT OR REPLACE INTO notify_ledger (tg_id, expiry, kind, status, sent_at) VALUES (?, ?, ?, ?, ?)",
+        rows
+    )
+    conn.commit()
+
+
+async def _flush_ledger(rows: list[tuple]):
+    if not rows:
+        return
+    # Копия: пока идёт запись, воркеры продолжают добавлять в rows
+    batch = list(rows)
+    rows.clear()
+    await run_state(_write_ledger, batch)
+
+
+def _is_unfinished(conn: sqlite3.Connection, run_date: str) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM notify_runs WHERE run_date = ? AND finished_at IS NULL", (run_date,)
+    ).fetchone()
+    return row is not None
+
 
 async def notify_users(bot: Bot):
+    with track_task("notify"):
+        await _notify_users(bot)
+
+
+async def _notify_users(bot: Bot):
     try:
-        clients = await get_all_clients()
-        notified = 0
+        with panel_priority(BACKGROUND):
+            clients = await get_all_clients()
+
+        today = datetime.now(MSK).date()
+        # Старые записи журнала не нужны: напоминаем только об окончании сегодня или завтра
+        day_start = datetime.now(MSK).replace(hour=0, minute=0, second=0, microsecond=0)
+        handled = await run_state(_start_run, today.isoformat(), int(day_start.timestamp() * 1000))
 
+        jobs = []
         for client in clients:
             tg_id = client.get("tgId")
             expiry_ms = client.get("expiryTime")
 
-            if not tg_id or not expiry_ms:
+            # Нечисловой tgId (username в старых версиях 3x-ui) — написать такому пользователю нельзя
+            if not tg_id or not expiry_ms or parse_tg_id(tg_id) is None:
                 continue
 
             expiry = get_expiry_datetime(expiry_ms)
             if not expiry or not is_expiring_soon(expiry):
                 continue
 
-            try:
-                # Переводим дату окончания в московское время
-                expiry_msk = expiry.astimezone(ZoneInfo("Europe/Moscow"))
-
-                # Создаем кнопки
-                button = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(text="🔁 Продлить подписку", callback_data="renew_subscription")],
-                        [InlineKeyboardButton(
-                            text="💬 Связаться с админом",
-                            url=f"tg://resolve?domain={ADMIN_USERNAME}&text={ADMIN_GREETING_TEXT.replace(' ', '%20')}"
-                        )]
-                    ]
-                )
+            kind = "today" if expiry.date() == today else "tomorrow"
+            key = (str(tg_id), expiry_ms, kind)
+            if key in handled:
+                continue
+            # Один пользователь может встречаться в нескольких inbound
+            handled.add(key)
+            jobs.append((key, expiry))
 
-                await bot.send_message(
-                    chat_id=tg_id,
+        queue: asyncio.Queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        notified = 0
+        ledger: list[tuple] = []
+
+        async def worker():
+            nonlocal notified
+            while not queue.empty():
+                (tg_id, expiry_ms, kind), expiry = queue.get_nowait()
+                status, error = await send_with_limits(
+                    bot,
+                    int(tg_id),
                     text=(
                         "⚠️ <b>Ваша подписка скоро закончится!</b>\n\n"
-                        f"📅 Дата окончания: <code>{expiry_msk.strftime('%d.%m.%Y %H:%M')}</code>\n\n"
+                        f"📅 Дата окончания: <code>{expiry.strftime('%d.%m.%Y %H:%M')}</code>\n\n"
                         "💬 Чтобы продлить доступ, нажмите одну из кнопок ниже."
                     ),
-                    reply_markup=button
+                    reply_markup=RENEW_KEYBOARD
                 )
-                notified += 1
-            except Exception as e:
-                print(f"[NOTIFIER] ❌ Ошибка при отправке уведомления пользователю {tg_id}: {e}")
+                ledger.append((tg_id, expiry_ms, kind, status, datetime.now(MSK).strftime("%Y-%m-%d %H:%M")))
+                if len(ledger) >= NOTIFY_LEDGER_BATCH:
+                    await _flush_ledger(ledger)
+                MESSAGES_SENT.inc(source="notify", status=status)
+                if status == "delivered":
+                    notified += 1
+                else:
+                    logger.error(
+                        f"❌ Ошибка при отправке уведомления пользователю {tg_id}: {error}",
+                        extra={"sample": "notify_send"}
+                    )
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, min(NOTIFY_WORKERS, len(jobs))))))
+        finally:
+            # Сохраняем то, что успели отправить, — при перезапуске эти напоминания не уйдут повторно
+            await _flush_ledger(ledger)
+
+        await run_state(_finish_run, today.isoformat())
 
-        print(f"[NOTIFIER] ✅ Уведомлено пользователей: {notified}")
+        logger.info(f"✅ Уведомлено пользователей: {notified}")
 
     except Exception as e:
-        print(f"[NOTIFIER] ❌ Ошибка при выполнении уведомлений: {e}")
+        logger.error(f"❌ Ошибка при выполнении уведомлений: {e}")
+        # Ошибка должна дойти до планировщика и метрик: иначе неудачный запуск записывается как успешный
+        raise
+
+
+async def resume_interrupted_run(bot: Bot):
+    """Дорабатывает сегодняшний запуск, если бот перезапустился посреди рассылки напоминаний"""
+    if not await run_state(_is_unfinished, datetime.now(MSK).date().isoformat()):
+        return
+    # Тот же тип задачи, что и у запуска по расписанию: в /jobs видна, отменяется через /cancel и не запустится дважды
+    try:
+        job, _ = job_runner.submit("notify", None, lambda: notify_users(bot))
+    except JobQueueFull:
+        logger.warning("⚠️ Очередь задач заполнена, прерванная рассылка напоминаний не продолжена")
+        return
+    logger.info(f"🔁 Продолжаем прерванную рассылку напоминаний (задача #{job.id})")
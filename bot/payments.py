@@ -0,0 +1,312 @@
+# bot/payments.py
+import os
+import logging
+import time
+import uuid
+import asyncio
+import sqlite3
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from aiogram import Bot
+from dotenv import load_dotenv
+from yookassa import Configuration, Payment
+from bot import referrals
+from bot.api import find_user_by_tg, extend_subscription
+from bot.state import run_state
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+Configuration.account_id = os.getenv("YOOKASSA_SHOP_ID")
+Configuration.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
+
+# Как часто опрашивать ЮKassa и сколько ждать оплаты (раньше — 60 попыток по 5 секунд)
+PAYMENT_POLL_INTERVAL = float(os.getenv("PAYMENT_POLL_INTERVAL", "5"))
+PAYMENT_TIMEOUT = float(os.getenv("PAYMENT_TIMEOUT", "300"))
+# Как часто повторять успешные платежи, которые не применились из-за недоступной панели
+PAYMENT_RETRY_INTERVAL = float(os.getenv("PAYMENT_RETRY_INTERVAL", "60"))
+# SDK ЮKassa синхронный: запросы к нему идут в отдельном пуле потоков
+YOOKASSA_WORKERS = int(os.getenv("YOOKASSA_WORKERS", "4"))
+
+_executor = ThreadPoolExecutor(max_workers=YOOKASSA_WORKERS, thread_name_prefix="yookassa")
+
+# Платежи, которые опрашивает сверщик: payment_id -> {tg_id, chat_id, plan, months, deadline}
+pending_payments: dict[str, dict] = {}
+_wakeup = asyncio.Event()
+
+# Состояние применения платежа в журнале
+APPLY_NONE = 0
+APPLY_CLAIMED = 1
+APPLY_DONE = 2
+APPLY_FAILED = 3
+
+
+# Журнал платежей: каждый платёж продлевает подписку не больше одного раза, в том числе после перезапуска.
+# Таблица payments создаётся миграциями в bot/state.py; функции ниже выполняются через run_state
+def _record_payment(conn: sqlite3.Connection, payment_id: str, provider: str, tg_id: int, chat_id: int,
+                    plan: str, months: int, status: str):
+    now = time.time()
+    # Повторная запись того же платежа (например, повторная доставка апдейта) ничего не меняет
+    conn.execute(
+        "INSERT OR IGNORE INTO payments (payment_id, provider, tg_id, chat_id, plan, months, status, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (payment_id, provider, tg_id, chat_id, plan, months, status, now, now)
+    )
+    conn.commit()
+
+
+async def record_payment(payment_id: str, provider: str, tg_id: int, chat_id: int, plan: str, months: int,
+                         status: str = "pending"):
+    await run_state(_record_payment, payment_id, provider, tg_id, chat_id, plan, months, status)
+
+
+def _get_payment(conn: sqlite3.Connection, payment_id: str) -> Optional[dict]:
+    row = conn.execute(
+        "SELECT tg_id, chat_id, plan, months, status, applied, created_at FROM payments WHERE payment_id = ?",
+        (payment_id,)
+    ).fetchone()
+    if not row:
+        return None
+    return dict(zip(("tg_id", "chat_id", "plan", "months", "status", "applied", "created_at"), row))
+
+
+def _set_status(conn: sqlite3.Connection, payment_id: str, status: str):
+    conn.execute(
+        "UPDATE payments SET status = ?, updated_at = ? WHERE payment_id = ?", (status, time.time(), payment_id)
+    )
+    conn.commit()
+
+
+def _claim(conn: sqlite3.Connection, payment_id: str) -> bool:
+    """Забирает платёж на применение; True получит только один вызывающий"""
+    cursor = conn.execute(
+        "UPDATE payments SET applied = ?, updated_at = ? WHERE payment_id = ? AND applied = ?",
+        (APPLY_CLAIMED, time.time(), payment_id, APPLY_NONE)
+    )
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def _set_applied(conn: sqlite3.Connection, payment_id: str, applied: int):
+    conn.execute(
+        "UPDATE payments SET applied = ?, updated_at = ? WHERE payment_id = ?", (applied, time.time(), payment_id)
+    )
+    conn.commit()
+
+
+def _find_reusable(conn: sqlite3.Connection, tg_id: int, plan: str) -> Optional[str]:
+    row = conn.execute(
+        "SELECT payment_id FROM payments WHERE provider = 'yookassa' AND tg_id = ? AND plan = ? "
+        "AND status IN ('pending', 'expired') ORDER BY created_at DESC LIMIT 1",
+        (tg_id, plan)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def _load_unapplied(conn: sqlite3.Connection) -> list[str]:
+    rows = conn.execute(
+        "SELECT payment_id FROM payments WHERE status = 'succeeded' AND applied = ? ORDER BY created_at",
+        (APPLY_NONE,)
+    ).fetchall()
+    return [row[0] for row in rows]
+
+
+def _load_pending(conn: sqlite3.Connection) -> tuple[list, list]:
+    rows = conn.execute(
+        "SELECT payment_id, tg_id, chat_id, plan, months, created_at FROM payments "
+        "WHERE provider = 'yookassa' AND status = 'pending'"
+    ).fetchall()
+    stuck = conn.execute("SELECT payment_id FROM payments WHERE applied = ?", (APPLY_CLAIMED,)).fetchall()
+    return rows, stuck
+
+
+async def load_pending_payments():
+    """Возвращает в опрос платежи, которые ожидали оплаты до перезапуска"""
+    rows, stuck = await run_state(_load_pending)
+    for payment_id, tg_id, chat_id, plan, months, created_at in rows:
+        pending_payments[payment_id] = {
+            "tg_id": tg_id,
+            "chat_id": chat_id,
+            "plan": plan,
+            "months": months,
+            "deadline": time.monotonic() + max(0.0, created_at + PAYMENT_TIMEOUT - time.time())
+        }
+    if rows:
+        logger.info(f"🔁 Возвращено в опрос платежей: {len(rows)}")
+    # Процесс упал посреди продления: было ли оно применено, знает только панель
+    for (payment_id,) in stuck:
+        logger.warning(f"⚠️ Платёж {payment_id} начал применяться до перезапуска — проверьте вручную")
+
+
+async def run_yookassa(fn: Callable[..., Any], *args) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args))
+
+
+# --- Создание платежа через API ЮKassa ---
+async def create_sbp_payment(tg_id: int, plan: str, price_info: dict):
+    # Незавершённый платёж по тому же тарифу переиспользуем, в том числе после перезапуска
+    old_payment_id = await run_state(_find_reusable, tg_id, plan)
+    if old_payment_id:
+        try:
+            payment = await run_yookassa(Payment.find_one, old_payment_id)
+            if payment.status in ["pending", "waiting_for_capture"]:
+                logger.info(f"Повторный вызов платежа {old_payment_id}")
+                return payment.confirmation.confirmation_url, old_payment_id
+        except Exception as e:
+            logger.warning(f"Ошибка при проверке старого платежа: {e}")
+
+    receipt = {
+        "customer": {
+            "full_name": f"User {tg_id}",
+            "email": f"user{tg_id}@null.core"  # или любой другой технический домен
+        },
+        "items": [
+            {
+                "description": f"Подписка на {price_info['label']}",
+                "quantity": 1.0,
+                "amount": {"value": price_info["value"], "currency": "RUB"},
+                "vat_code": 1
+            }
+        ]
+    }
+
+    try:
+        new_payment = await run_yookassa(Payment.create, {
+            "amount": {"value": price_info["value"], "currency": "RUB"},
+            "payment_method_data": {"type": "sbp"},
+            "confirmation": {"type": "redirect", "return_url": "https://t.me/nullcorevpn_bot"},
+            "capture": True,
+            "description": f"Подписка на {price_info['label']}",
+            "metadata": {"tg_id": str(tg_id), "plan": plan},
+            "receipt": receipt
+        }, uuid.uuid4().hex)
+
+        return new_payment.confirmation.confirmation_url, new_payment.id
+
+    except Exception as e:
+        logger.error(f"Ошибка создания платежа: {e}")
+        return None, None
+
+
+async def track_payment(payment_id: str, tg_id: int, chat_id: int, plan: str, months: int):
+    """Записывает платёж в журнал и передаёт сверщику; обработчик после этого сразу возвращается"""
+    await record_payment(payment_id, "yookassa", tg_id, chat_id, plan, months)
+    await run_state(_set_status, payment_id, "pending")
+    pending_payments[payment_id] = {
+        "tg_id": tg_id,
+        "chat_id": chat_id,
+        "plan": plan,
+        "months": months,
+        "deadline": time.monotonic() + PAYMENT_TIMEOUT
+    }
+    _wakeup.set()
+
+
+async def apply_payment(bot: Bot, payment_id: str, notify_delay: bool = True) -> bool:
+    """Продлевает подписку по успешному платежу из журнала; повторный вызов ничего не делает"""
+    info = await run_state(_get_payment, payment_id)
+    if not info or info["applied"] != APPLY_NONE:
+        logger.info(f"Платёж {payment_id} уже применён или применяется")
+        return False
+    tg_id = info["tg_id"]
+    # Пользователя ищем до того, как забрать платёж: пока в панель ничего не записано, повтор безопасен
+    try:
+        # Новая дата считается от текущей, поэтому устаревший снимок здесь не подходит
+        user = await find_user_by_tg(tg_id, allow_stale=False, raise_unavailable=True)
+    except Exception as e:
+        logger.warning(f"⚠️ Платёж {payment_id}: панель недоступна ({type(e).__name__}: {e}), повторим позже")
+        if notify_delay:
+            await bot.send_message(
+                info["chat_id"], "⏳ Оплата получена. Подписка будет продлена автоматически в ближайшее время."
+            )
+        return False
+
+    if not await run_state(_claim, payment_id):
+        logger.info(f"Платёж {payment_id} уже применён или применяется")
+        return False
+    new_expiry = await extend_subscription(user, info["months"]) if user else None
+    # Неудачное продление не повторяем автоматически: панель могла применить его без ответа
+    await run_state(_set_applied, payment_id, APPLY_DONE if new_expiry else APPLY_FAILED)
+    if new_expiry:
+        logger.info(f"✅ Платёж {payment_id} применён: {tg_id} до {new_expiry:%d.%m.%Y}")
+        await referrals.mark_as_paid(tg_id, bot)
+        await bot.send_message(
+            info["chat_id"], f"✅ Подписка продлена до <b>{new_expiry.strftime('%d.%m.%Y %H:%M')}</b>"
+        )
+        return True
+    logger.error(f"❌ Платёж {payment_id} прошёл, но подписку {tg_id} продлить не удалось")
+    await bot.send_message(
+        info["chat_id"],
+        "⚠️ Пользователь не найден." if not user
+        else "❌ Не удалось продлить подписку после оплаты. Обратитесь к администратору."
+    )
+    return False
+
+
+async def _retry_unapplied(bot: Bot):
+    """Повторяет успешные платежи, отложенные из-за недоступной панели"""
+    for payment_id in await run_state(_load_unapplied):
+        try:
+            await apply_payment(bot, payment_id, notify_delay=False)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось повторно применить платёж {payment_id}: {type(e).__name__}: {e}")
+
+
+async def _settle(bot: Bot, payment_id: str, status: str):
+    """Записывает статус платежа из ЮKassa и завершает отслеживание, если он окончательный"""
+    info = pending_payments.get(payment_id)
+    if status == "succeeded":
+        pending_payments.pop(payment_id, None)
+        await run_state(_set_status, payment_id, "succeeded")
+        await apply_payment(bot, payment_id)
+    elif status == "canceled":
+        pending_payments.pop(payment_id, None)
+        await run_state(_set_status, payment_id, "canceled")
+        if info:
+            await bot.send_message(info["chat_id"], "❌ Платёж отменён.")
+    elif info and time.monotonic() > info["deadline"]:
+        # Ссылка остаётся рабочей: поздняя оплата придёт уведомлением, а кнопка выдаст ту же ссылку
+        pending_payments.pop(payment_id, None)
+        await run_state(_set_status, payment_id, "expired")
+        await bot.send_message(info["chat_id"], "⏳ Время ожидания истекло. Оплата не подтверждена.")
+
+
+async def _check(bot: Bot, payment_id: str):
+    try:
+        payment = await run_yookassa(Payment.find_one, payment_id)
+        await _settle(bot, payment_id, payment.status)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось проверить платёж {payment_id}: {type(e).__name__}: {e}")
+
+
+async def reconcile_payments(bot: Bot):
+    """Один сверщик на все ожидающие платежи: опрашивает ЮKassa пачкой, а не по задаче на платёж"""
+    await load_pending_payments()
+    retry_at = 0.0
+    while True:
+        if not pending_payments:
+            # Просыпаемся и без новых платежей — чтобы повторить отложенные
+            try:
+                await asyncio.wait_for(_wakeup.wait(), PAYMENT_RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        _wakeup.clear()
+        if time.monotonic() >= retry_at:
+            retry_at = time.monotonic() + PAYMENT_RETRY_INTERVAL
+            await _retry_unapplied(bot)
+        # Запросы выполняются параллельно; их число ограничено размером пула YOOKASSA_WORKERS
+        await asyncio.gather(*(_check(bot, payment_id) for payment_id in list(pending_payments)))
+        await asyncio.sleep(PAYMENT_POLL_INTERVAL)
+
+
+async def handle_notification(bot: Bot, data: dict):
+    """Уведомление ЮKassa о смене статуса; телу запроса не доверяем и перепроверяем платёж через API"""
+    payment_id = (data.get("object") or {}).get("id")
+    # Платёж может быть уже снят с опроса по таймауту — проверяем по журналу
+    if not payment_id or not await run_state(_get_payment, payment_id):
+        return
+    logger.info(f"Уведомление {data.get('event')} по платежу {payment_id}")
+    await _check(bot, payment_id)
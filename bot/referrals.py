@@ -1,24 +1,63 @@
 import os
+import logging
+import json
+import asyncio
+import time
 import random
 import string
 import sqlite3
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from typing import Optional
-import gspread
+from typing import Any, Callable, Optional
+from aiogram import Bot
+from bot.api import find_user_by_tg, extend_subscription
+from bot.sheets import run_sheets, get_worksheet
+from bot.state import get_mark, set_mark
 
 load_dotenv()
-SPREADSHEET_NAME = os.getenv("SPREADSHEET_NAME")
+
+logger = logging.getLogger(__name__)
 SHEET_TAB = os.getenv("SHEET_TAB_REF")
-CREDENTIALS_PATH = os.getenv("GOOGLE_CREDENTIALS_PATH")
+# Сколько строк отправлять в Google Sheets одним запросом
+REF_EXPORT_CHUNK = int(os.getenv("REF_EXPORT_CHUNK", "500"))
 
 DB_PATH = os.path.join("data", "referrals.db")
 
+# Каждые REF_BONUS_THRESHOLD оплативших приглашённых дают REF_BONUS_MONTHS месяцев подписки
+REF_BONUS_THRESHOLD = int(os.getenv("REF_BONUS_THRESHOLD", "5"))
+REF_BONUS_MONTHS = int(os.getenv("REF_BONUS_MONTHS", "1"))
+ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_ID", "").split(",") if x.strip()]
+
+# Состояние ступени бонуса — как applied в журнале платежей (bot/payments.py)
+BONUS_PENDING = 0
+BONUS_CLAIMED = 1
+BONUS_DONE = 2
+BONUS_FAILED = 3
+
+
+# Все запросы идут через один поток и одно долгоживущее соединение: SQLite не блокирует event loop
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="referrals-db")
+_conn: Optional[sqlite3.Connection] = None
+
+
+def _add_updated_at(conn: sqlite3.Connection):
+    # В базах до версионирования колонка могла уже появиться
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(referrals)")]
+    if "updated_at" not in columns:
+        conn.execute("ALTER TABLE referrals ADD COLUMN updated_at REAL")
+
 
-# Подключение к SQLite
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute('''
+def _add_bonus_state(conn: sqlite3.Connection):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(referral_bonuses)")]
+    if "state" not in columns:
+        conn.execute(f"ALTER TABLE referral_bonuses ADD COLUMN state INTEGER DEFAULT {BONUS_PENDING}")
+    conn.execute("UPDATE referral_bonuses SET state = ? WHERE applied_at IS NOT NULL", (BONUS_DONE,))
+
+
+# Миграции схемы по порядку; номер последней применённой хранится в PRAGMA user_version
+MIGRATIONS = [
+    lambda conn: conn.execute('''
         CREATE TABLE IF NOT EXISTS referrals (
             inviter_tg_id TEXT,
             invited_tg_id TEXT,
@@ -27,8 +66,87 @@ def get_conn():
             bonus_status TEXT DEFAULT 'Нет бонуса',
             is_paid INTEGER DEFAULT 0
         )
-    ''')
-    return conn
+    '''),
+    # updated_at нужен для инкрементальной выгрузки изменённых строк
+    _add_updated_at,
+    lambda conn: conn.executescript('''
+        CREATE INDEX IF NOT EXISTS idx_referrals_ref_code ON referrals (ref_code);
+        CREATE INDEX IF NOT EXISTS idx_referrals_invited ON referrals (invited_tg_id);
+        CREATE INDEX IF NOT EXISTS idx_referrals_inviter ON referrals (inviter_tg_id, is_paid);
+    '''),
+    # Начисленные бонусы: ступень N — за N * REF_BONUS_THRESHOLD оплативших приглашённых
+    lambda conn: conn.execute('''
+        CREATE TABLE IF NOT EXISTS referral_bonuses (
+            inviter_tg_id TEXT,
+            tier INTEGER,
+            granted_at TEXT,
+            applied_at TEXT,
+            PRIMARY KEY (inviter_tg_id, tier)
+        )
+    '''),
+    # Ступень забирается до записи в панель, чтобы повтор после таймаута не продлил подписку дважды
+    _add_bonus_state,
+]
+
+
+def _migrate(conn: sqlite3.Connection):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        # PRAGMA не принимает параметры
+        conn.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+        logger.info(f"Схема базы обновлена до версии {number}")
+
+
+# Подключение к SQLite; вызывать только из потока _db_executor
+def get_conn() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(DB_PATH)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _migrate(conn)
+        _conn = conn
+    return _conn
+
+
+async def run_db(fn: Callable[..., Any], *args) -> Any:
+    """Выполняет fn(conn, *args) в потоке базы рефералов"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, lambda: fn(get_conn(), *args))
+
+
+def _unfinished_bonuses(conn: sqlite3.Connection) -> list[tuple]:
+    return conn.execute(
+        "SELECT inviter_tg_id, tier, state FROM referral_bonuses WHERE state IN (?, ?) ORDER BY inviter_tg_id, tier",
+        (BONUS_CLAIMED, BONUS_FAILED)
+    ).fetchall()
+
+
+async def init_db():
+    """Открывает базу и применяет миграции; вызывается один раз при старте"""
+    # Процесс упал посреди продления или продление не удалось: было ли оно применено, знает только панель
+    for inviter_tg_id, tier, state in await run_db(_unfinished_bonuses):
+        reason = "начал применяться до перезапуска" if state == BONUS_CLAIMED else "не удалось применить"
+        logger.warning(f"⚠️ Бонус {inviter_tg_id} (ступень {tier}) {reason} — проверьте вручную")
+
+
+def _close_conn():
+    global _conn
+    if _conn is None:
+        return
+    # Переносим журнал в основной файл, чтобы база на диске была полной и без -wal
+    _conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    _conn.close()
+    _conn = None
+
+
+async def close_db():
+    """Закрывает соединение при остановке бота"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_db_executor, _close_conn)
 
 
 # Генерация уникального кода
@@ -36,69 +154,61 @@ def generate_ref_code(length=8):
     return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
 
 
-# Получить ref_code пользователя, или создать новый
-def get_or_create_ref_code(tg_id: int) -> str:
-    conn = get_conn()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT ref_code FROM referrals WHERE inviter_tg_id = ? AND invited_tg_id IS NULL", (str(tg_id),))
-    row = cursor.fetchone()
+def _get_or_create_ref_code(conn: sqlite3.Connection, tg_id: int) -> str:
+    row = conn.execute(
+        "SELECT ref_code FROM referrals WHERE inviter_tg_id = ? AND invited_tg_id IS NULL", (str(tg_id),)
+    ).fetchone()
     if row:
-        conn.close()
         return row[0]
 
     ref_code = generate_ref_code()
     now = datetime.now().strftime("%Y-%m-%d %H:%M")
-    cursor.execute(
-        "INSERT INTO referrals (inviter_tg_id, invited_tg_id, ref_code, created_at) VALUES (?, NULL, ?, ?)",
-        (str(tg_id), ref_code, now)
+    conn.execute(
+        "INSERT INTO referrals (inviter_tg_id, invited_tg_id, ref_code, created_at, updated_at) VALUES (?, NULL, ?, ?, ?)",
+        (str(tg_id), ref_code, now, time.time())
     )
     conn.commit()
-    conn.close()
     return ref_code
 
 
-# Сохранить связь только если её ещё нет
-def save_referral(inviter_tg_id: int, invited_tg_id: int, ref_code: str):
-    conn = get_conn()
-    cursor = conn.cursor()
+# Получить ref_code пользователя, или создать новый
+async def get_or_create_ref_code(tg_id: int) -> str:
+    return await run_db(_get_or_create_ref_code, tg_id)
 
-    cursor.execute("SELECT 1 FROM referrals WHERE invited_tg_id = ?", (str(invited_tg_id),))
-    if cursor.fetchone():
-        conn.close()
+
+def _save_referral(conn: sqlite3.Connection, inviter_tg_id: int, invited_tg_id: int, ref_code: str):
+    if conn.execute("SELECT 1 FROM referrals WHERE invited_tg_id = ?", (str(invited_tg_id),)).fetchone():
         return  # Уже записан как приглашённый
 
     now = datetime.now().strftime("%Y-%m-%d %H:%M")
-    cursor.execute(
-        "INSERT INTO referrals (inviter_tg_id, invited_tg_id, ref_code, created_at) VALUES (?, ?, ?, ?)",
-        (str(inviter_tg_id), str(invited_tg_id), ref_code, now)
+    conn.execute(
+        "INSERT INTO referrals (inviter_tg_id, invited_tg_id, ref_code, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (str(inviter_tg_id), str(invited_tg_id), ref_code, now, time.time())
     )
     conn.commit()
-    conn.close()
 
 
-# Получить всех приглашённых
-def get_referrals_by_inviter(inviter_tg_id: int) -> list[dict]:
-    conn = get_conn()
-    cursor = conn.cursor()
+# Сохранить связь только если её ещё нет
+async def save_referral(inviter_tg_id: int, invited_tg_id: int, ref_code: str):
+    await run_db(_save_referral, inviter_tg_id, invited_tg_id, ref_code)
 
-    cursor.execute("SELECT invited_tg_id, created_at, bonus_status FROM referrals WHERE inviter_tg_id = ? AND is_paid = 1", (str(inviter_tg_id),))
-    rows = cursor.fetchall()
-    conn.close()
 
-    result = []
-    for row in rows:
-        result.append({
-            "tg_id": row[0],
-            "date": row[1],
-            "bonus": row[2]
-        })
-    return result
+def _get_referrals_by_inviter(conn: sqlite3.Connection, inviter_tg_id: int) -> list[dict]:
+    rows = conn.execute(
+        "SELECT invited_tg_id, created_at, bonus_status FROM referrals WHERE inviter_tg_id = ? AND is_paid = 1",
+        (str(inviter_tg_id),)
+    ).fetchall()
+    return [{"tg_id": row[0], "date": row[1], "bonus": row[2]} for row in rows]
+
+
+# Получить всех приглашённых
+async def get_referrals_by_inviter(inviter_tg_id: int) -> list[dict]:
+    return await run_db(_get_referrals_by_inviter, inviter_tg_id)
 
 
 # Отправить пользователю его ссылку
 async def send_referral_link(bot, user_id, chat_id):
-    ref_code = get_or_create_ref_code(user_id)
+    ref_code = await get_or_create_ref_code(user_id)
     bot_name = os.getenv("BOT_USERNAME")
     ref_link = f"t.me/{bot_name}?start=ref_{ref_code}"
     await bot.send_message(
@@ -112,35 +222,316 @@ async def send_referral_link(bot, user_id, chat_id):
         parse_mode="HTML"
     )
 
-async def export_to_gsheet():
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM referrals WHERE invited_tg_id IS NOT NULL")
-    rows = cursor.fetchall()
-    conn.close()
+REF_HEADER = ["inviter_tg_id", "invited_tg_id", "ref_code", "created_at", "bonus_status", "is_paid"]
+REF_COLUMNS = "inviter_tg_id, invited_tg_id, ref_code, created_at, bonus_status, is_paid"
+# Водяной знак выгрузки: последний выгруженный rowid и updated_at
+REF_EXPORT_MARK = "referrals_export"
+
+
+def _sheet_row(row) -> list[str]:
+    return [str(col) if col is not None else "" for col in row]
+
 
-    gc = gspread.service_account(filename=CREDENTIALS_PATH)
-    sh = gc.open(SPREADSHEET_NAME)
-    ws = sh.worksheet(SHEET_TAB)
+def _chunked_ranges(first_row: int, rows: list) -> list[dict]:
+    ranges = []
+    for i in range(0, len(rows), REF_EXPORT_CHUNK):
+        chunk = rows[i:i + REF_EXPORT_CHUNK]
+        start = first_row + i
+        ranges.append({"range": f"A{start}:F{start + len(chunk) - 1}", "values": chunk})
+    return ranges
+
+
+def _upload_full(rows: list):
+    ws = get_worksheet(SHEET_TAB)
     ws.clear()
-    ws.append_row(["inviter_tg_id", "invited_tg_id", "ref_code", "created_at", "bonus_status", "is_paid"])
+    # Лист ровно под данные: хватает места и не остаётся хвоста от прошлой выгрузки
+    ws.resize(rows=len(rows) + 1)
+    ws.update(values=[REF_HEADER], range_name="A1:F1")
+    for value_range in _chunked_ranges(2, rows):
+        ws.update(values=value_range["values"], range_name=value_range["range"])
+
+
+def _upload_changes(new_rows: list, changed_rows: list) -> bool:
+    """Дописывает новые строки и обновляет изменённые; False — если лист пуст и нужна полная выгрузка"""
+    ws = get_worksheet(SHEET_TAB)
+    # Строки ищем по invited_tg_id (колонка B); без заголовка лист считаем пустым
+    column = ws.col_values(2)
+    if not column or column[0] != REF_HEADER[1]:
+        return False
+
+    row_numbers = {tg_id: i for i, tg_id in enumerate(column, start=1) if i > 1 and tg_id}
+    value_ranges = []
+    appended = []
+    for row in changed_rows:
+        row_number = row_numbers.get(row[1])
+        if row_number:
+            value_ranges.append({"range": f"A{row_number}:F{row_number}", "values": [row]})
+        else:
+            appended.append(row)
+    appended.extend(new_rows)
+
+    first = len(column) + 1
+    if appended:
+        needed_rows = first + len(appended) - 1
+        if needed_rows > ws.row_count:
+            ws.add_rows(needed_rows - ws.row_count)
+        value_ranges.extend(_chunked_ranges(first, appended))
+    for i in range(0, len(value_ranges), REF_EXPORT_CHUNK):
+        ws.batch_update(value_ranges[i:i + REF_EXPORT_CHUNK])
+    return True
+
+
+def _select_for_export(conn: sqlite3.Connection, mark: Optional[dict]) -> tuple[list, list]:
+    """Строки для выгрузки: (новые, изменённые); без водяного знака — все строки как новые"""
+    if mark is None:
+        rows = conn.execute(
+            f"SELECT rowid, updated_at, {REF_COLUMNS} FROM referrals WHERE invited_tg_id IS NOT NULL ORDER BY rowid"
+        ).fetchall()
+        return rows, []
+    new_rows = conn.execute(
+        f"SELECT rowid, updated_at, {REF_COLUMNS} FROM referrals "
+        "WHERE invited_tg_id IS NOT NULL AND rowid > ? ORDER BY rowid",
+        (mark["rowid"],)
+    ).fetchall()
+    changed_rows = conn.execute(
+        f"SELECT rowid, updated_at, {REF_COLUMNS} FROM referrals "
+        "WHERE invited_tg_id IS NOT NULL AND rowid <= ? AND updated_at > ? ORDER BY rowid",
+        (mark["rowid"], mark["updated_at"])
+    ).fetchall()
+    return new_rows, changed_rows
+
+
+async def export_to_gsheet(full: bool = False):
+    """Выгружает рефералов в Google Sheets: полностью при первом запуске, дальше — только новые и изменённые"""
+    mark = await get_mark(REF_EXPORT_MARK)
+    mark = json.loads(mark) if mark else None
+    full = full or mark is None
+
+    new_rows, changed_rows = await run_db(_select_for_export, None if full else mark)
+
+    if not full and not new_rows and not changed_rows:
+        logger.info("Реферальная таблица актуальна")
+        return
 
-    for row in rows:
-        ws.append_row([str(col) if col is not None else "" for col in row])
+    # Водяной знак считаем по выгружаемым строкам: всё, что изменится позже, попадёт в следующий запуск.
+    # rowid только растёт: изменённые строки лежат ниже знака и не должны его опускать
+    exported = new_rows + changed_rows
+    new_mark = {
+        "rowid": max([row[0] for row in new_rows] + [mark["rowid"] if mark else 0]),
+        "updated_at": max([row[1] or 0 for row in exported] + [mark["updated_at"] if mark else 0])
+    }
+    new_values = [_sheet_row(row[2:]) for row in new_rows]
+    changed_values = [_sheet_row(row[2:]) for row in changed_rows]
 
-def get_inviter_by_code(ref_code: str) -> Optional[int]:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    if full:
+        await run_sheets(_upload_full, new_values)
+    elif not await run_sheets(_upload_changes, new_values, changed_values):
+        # Лист очистили вручную — инкремента недостаточно
+        await export_to_gsheet(full=True)
+        return
+    await set_mark(REF_EXPORT_MARK, json.dumps(new_mark))
+    logger.info(
+        f"Выгрузка {'полная' if full else 'инкрементальная'}: "
+        f"новых строк {len(new_rows)}, изменённых {len(changed_rows)}"
+    )
+
+def _get_inviter_by_code(conn: sqlite3.Connection, ref_code: str) -> Optional[int]:
+    row = conn.execute("SELECT inviter_tg_id FROM referrals WHERE ref_code = ? LIMIT 1", (ref_code,)).fetchone()
+    return int(row[0]) if row else None
+
+
+async def get_inviter_by_code(ref_code: str) -> Optional[int]:
+    return await run_db(_get_inviter_by_code, ref_code)
+
+
+def _mark_as_paid(conn: sqlite3.Connection, tg_id: int) -> Optional[str]:
+    """Возвращает пригласившего, если оплата засчитана впервые"""
+    row = conn.execute(
+        "SELECT inviter_tg_id FROM referrals WHERE invited_tg_id = ? AND is_paid = 0", (str(tg_id),)
+    ).fetchone()
+    conn.execute(
+        "UPDATE referrals SET is_paid = 1, updated_at = ? WHERE invited_tg_id = ? AND is_paid = 0",
+        (time.time(), str(tg_id))
+    )
+    conn.commit()
+    return row[0] if row else None
+
+
+_bonus_locks: dict[str, asyncio.Lock] = {}
+
+
+async def mark_as_paid(tg_id: int, bot: Optional[Bot] = None):
+    inviter_tg_id = await run_db(_mark_as_paid, tg_id)
+    if inviter_tg_id:
+        # Счётчик пригласившего изменился — проверяем только его
+        await process_bonuses([inviter_tg_id], bot)
+
+
+def _grant_bonuses(conn: sqlite3.Connection, inviters: list[str]) -> list[str]:
+    """Записывает новые ступени бонусов указанным пригласившим и возвращает тех, у кого есть неприменённые"""
+    placeholders = ','.join('?' * len(inviters))
+    query = (
+        "SELECT inviter_tg_id, COUNT(*) FROM referrals "
+        f"WHERE is_paid = 1 AND invited_tg_id IS NOT NULL AND inviter_tg_id IN ({placeholders}) "
+        "GROUP BY inviter_tg_id HAVING COUNT(*) >= ?"
+    )
+    params = [*inviters, REF_BONUS_THRESHOLD]
+
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    for inviter_tg_id, paid_count in conn.execute(query, params).fetchall():
+        # INSERT OR IGNORE: уже записанная ступень второй раз не начисляется
+        conn.executemany(
+            "INSERT OR IGNORE INTO referral_bonuses (inviter_tg_id, tier, granted_at) VALUES (?, ?, ?)",
+            [(inviter_tg_id, tier, now) for tier in range(1, paid_count // REF_BONUS_THRESHOLD + 1)]
+        )
+    conn.commit()
+
+    return _pending_inviters(conn, inviters)
+
+
+def _pending_inviters(conn: sqlite3.Connection, inviters: Optional[list[str]] = None) -> list[str]:
+    """Пригласившие с неприменёнными ступенями — среди указанных или все"""
+    query = "SELECT DISTINCT inviter_tg_id FROM referral_bonuses WHERE state = ?"
+    params: list = [BONUS_PENDING]
+    if inviters is not None:
+        query += f" AND inviter_tg_id IN ({','.join('?' * len(inviters))})"
+        params.extend(inviters)
+    return [row[0] for row in conn.execute(query, params)]
+
+
+def _pending_tiers(conn: sqlite3.Connection, inviter_tg_id: str) -> list[int]:
+    rows = conn.execute(
+        "SELECT tier FROM referral_bonuses WHERE inviter_tg_id = ? AND state = ? ORDER BY tier",
+        (inviter_tg_id, BONUS_PENDING)
+    )
+    return [row[0] for row in rows]
 
-    cursor.execute("SELECT inviter_tg_id FROM referrals WHERE ref_code = ? LIMIT 1", (ref_code,))
-    result = cursor.fetchone()
-    conn.close()
 
-    return result[0] if result else None
+def _claim_tiers(conn: sqlite3.Connection, inviter_tg_id: str, tiers: list[int]) -> list[int]:
+    """Забирает ступени на применение; каждую получит только один вызывающий"""
+    claimed = []
+    for tier in tiers:
+        cursor = conn.execute(
+            "UPDATE referral_bonuses SET state = ? WHERE inviter_tg_id = ? AND tier = ? AND state = ?",
+            (BONUS_CLAIMED, inviter_tg_id, tier, BONUS_PENDING)
+        )
+        if cursor.rowcount == 1:
+            claimed.append(tier)
+    conn.commit()
+    return claimed
 
-def mark_as_paid(tg_id: int):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE referrals SET is_paid = 1 WHERE invited_tg_id = ?", (str(tg_id),))
+
+def _set_tiers_state(conn: sqlite3.Connection, inviter_tg_id: str, tiers: list[int], state: int):
+    conn.executemany(
+        "UPDATE referral_bonuses SET state = ? WHERE inviter_tg_id = ? AND tier = ?",
+        [(state, inviter_tg_id, tier) for tier in tiers]
+    )
     conn.commit()
-    conn.close()
+
+
+def _apply_bonuses(conn: sqlite3.Connection, inviter_tg_id: str, tiers: list[int]):
+    conn.executemany(
+        "UPDATE referral_bonuses SET state = ?, applied_at = ? WHERE inviter_tg_id = ? AND tier = ?",
+        [(BONUS_DONE, datetime.now().strftime("%Y-%m-%d %H:%M"), inviter_tg_id, tier) for tier in tiers]
+    )
+    # Помечаем приглашённых, за которых бонус уже выдан
+    conn.execute(
+        "UPDATE referrals SET bonus_status = 'Бонус начислен', updated_at = ? WHERE rowid IN ("
+        "  SELECT rowid FROM referrals WHERE inviter_tg_id = ? AND is_paid = 1 AND invited_tg_id IS NOT NULL"
+        "  ORDER BY rowid LIMIT ?"
+        ")",
+        (time.time(), inviter_tg_id, max(tiers) * REF_BONUS_THRESHOLD)
+    )
+    conn.commit()
+
+
+async def _extend_for_bonus(inviter_tg_id: str, bot: Optional[Bot]) -> bool:
+    # Две оплаты подряд не должны продлить подписку за одну ступень дважды
+    async with _bonus_locks.setdefault(inviter_tg_id, asyncio.Lock()):
+        tiers = await run_db(_pending_tiers, inviter_tg_id)
+        if not tiers:
+            return False
+        return await _apply_extension(inviter_tg_id, tiers, bot)
+
+
+async def _report_failed(inviter_tg_id: str, tiers: list[int], bot: Optional[Bot], reason: str):
+    logger.error(f"❌ Бонус {inviter_tg_id} (ступени {tiers}) не применён: {reason} — проверьте вручную")
+    if not bot:
+        return
+    for admin_id in ADMIN_IDS:
+        try:
+            await bot.send_message(
+                admin_id,
+                f"⚠️ Реферальный бонус для {inviter_tg_id} (ступени {', '.join(map(str, tiers))}) "
+                f"не удалось применить: {reason}. Проверьте подписку в панели и продлите вручную."
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось уведомить администратора {admin_id}: {e}")
+
+
+async def _apply_extension(inviter_tg_id: str, tiers: list[int], bot: Optional[Bot]) -> bool:
+    # Пользователя ищем до того, как забрать ступени: пока в панель ничего не записано, повтор безопасен
+    try:
+        user = await find_user_by_tg(int(inviter_tg_id), allow_stale=False, raise_unavailable=True)
+    except Exception as e:
+        logger.warning(f"⚠️ Бонус {inviter_tg_id}: панель недоступна ({type(e).__name__}: {e}), повторим позже")
+        return False
+    if not user:
+        # Подписки ещё нет — бонус останется неприменённым до следующей проверки
+        logger.warning(f"Пригласивший {inviter_tg_id} не найден в панели, бонус отложен")
+        return False
+
+    tiers = await run_db(_claim_tiers, inviter_tg_id, tiers)
+    if not tiers:
+        return False
+
+    months = len(tiers) * REF_BONUS_MONTHS
+    # Безлимитную подписку продлевать некуда — бонус просто отмечаем выданным.
+    # После неудачной или оборвавшейся записи ступени в очередь не возвращаются: запись могла дойти до панели
+    if user["expiryTime"]:
+        try:
+            extended = await extend_subscription(user, months)
+            reason = "панель не подтвердила продление"
+        except Exception as e:
+            extended = None
+            reason = f"{type(e).__name__}: {e}"
+        if not extended:
+            await run_db(_set_tiers_state, inviter_tg_id, tiers, BONUS_FAILED)
+            await _report_failed(inviter_tg_id, tiers, bot, reason)
+            return False
+
+    await run_db(_apply_bonuses, inviter_tg_id, tiers)
+    logger.info(f"🎁 Пригласившему {inviter_tg_id} начислено месяцев: {months}")
+    if bot:
+        try:
+            await bot.send_message(
+                int(inviter_tg_id),
+                f"🎁 Ваши приглашённые оплатили подписку — начислен бонус: {months} мес. бесплатной подписки!"
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось уведомить {inviter_tg_id} о бонусе: {e}")
+    return True
+
+
+async def process_bonuses(inviters: list[str], bot: Optional[Bot] = None) -> int:
+    """Начисляет бонусы указанным пригласившим и применяет неприменённые; возвращает число продлений"""
+    return await _extend_pending(await run_db(_grant_bonuses, inviters), bot)
+
+
+async def retry_pending_bonuses(bot: Optional[Bot] = None) -> int:
+    """Повторяет ступени, отложенные из-за недоступной панели; новые ступени начисляет mark_as_paid, таблицу
+    рефералов не пересчитываем"""
+    return await _extend_pending(await run_db(_pending_inviters), bot)
+
+
+async def _extend_pending(pending: list[str], bot: Optional[Bot]) -> int:
+    if not pending:
+        return 0
+    results = await asyncio.gather(
+        *(_extend_for_bonus(inviter_tg_id, bot) for inviter_tg_id in pending),
+        return_exceptions=True
+    )
+    for inviter_tg_id, result in zip(pending, results):
+        if isinstance(result, Exception):
+            logger.error(f"❌ Ошибка при начислении бонуса {inviter_tg_id}: {type(result).__name__}: {result}")
+    return sum(1 for result in results if result is True)
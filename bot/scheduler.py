@@ -0,0 +1,209 @@
+# bot/scheduler.py
+import os
+import logging
+import time
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+from zoneinfo import ZoneInfo
+from aiogram import Bot
+from dotenv import load_dotenv
+from bot.jobs import job_runner, JobQueueFull
+from bot.notifier import notify_users
+from bot.state import run_state
+from bot.sync import sync_to_google_sheets
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MSK = ZoneInfo("Europe/Moscow")
+# Расписания в формате cron (минута час день месяц день_недели), время московское
+SCHEDULE_NOTIFY = os.getenv("SCHEDULE_NOTIFY", "0 18 * * *")
+SCHEDULE_SYNC = os.getenv("SCHEDULE_SYNC", "0 9 * * *")
+# Даже при далёком следующем запуске просыпаемся не реже раза в минуту — на случай перевода часов
+SCHEDULER_MAX_SLEEP = 60.0
+
+
+class CronSpec:
+    """Cron-выражение из пяти полей: *, числа, списки через запятую, диапазоны a-b и шаги */n"""
+
+    # День недели: 0 и 7 — воскресенье
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, spec: str):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"Ожидается 5 полей cron, получено: {spec!r}")
+        self.spec = spec
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES)
+        )
+        self.weekdays = {day % 7 for day in weekdays}
+        # Как в cron: если заданы и день месяца, и день недели, подходит любой из них
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> set[int]:
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_str = part.split("/")
+                step = int(step_str)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = (int(x) for x in part.split("-"))
+            else:
+                start = end = int(part)
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Недопустимое поле cron: {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        day_ok = dt.day in self.days
+        # isoweekday: 1 — понедельник … 7 — воскресенье; в cron воскресенье — 0
+        weekday_ok = dt.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, dt: datetime) -> datetime:
+        """Ближайший момент строго после dt"""
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 4)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f"Расписание {self.spec!r} никогда не срабатывает")
+
+
+class ScheduledJob:
+    def __init__(self, name: str, spec: str, func: Callable[[Bot], Awaitable[Any]]):
+        self.name = name
+        self.cron = CronSpec(spec)
+        self.func = func
+        self.next_run: Optional[datetime] = None
+
+
+# Задачи выполняются через job_runner под тем же ключом, что и ручной /sync, — запуски не пересекаются
+scheduled_jobs = [
+    ScheduledJob("notify", SCHEDULE_NOTIFY, notify_users),
+    ScheduledJob("sync", SCHEDULE_SYNC, sync_to_google_sheets),
+]
+
+
+# Таблицы schedules и schedule_runs создаются миграциями в bot/state.py
+def _load_next_runs(conn: sqlite3.Connection) -> Dict[str, datetime]:
+    rows = conn.execute("SELECT name, next_run_at FROM schedules WHERE next_run_at IS NOT NULL").fetchall()
+    return {name: datetime.fromisoformat(next_run_at) for name, next_run_at in rows}
+
+
+def _save_schedule(conn: sqlite3.Connection, name: str, next_run: datetime, last_run: Optional[datetime] = None):
+    conn.execute(
+        "INSERT INTO schedules (name, last_run_at, next_run_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET next_run_at = excluded.next_run_at, "
+        "last_run_at = COALESCE(excluded.last_run_at, schedules.last_run_at)",
+        (name, last_run.isoformat() if last_run else None, next_run.isoformat())
+    )
+    conn.commit()
+
+
+def _record_run(conn: sqlite3.Connection, name: str, started_at: datetime, duration: float, status: str,
+                error: Optional[str]):
+    conn.execute(
+        "INSERT INTO schedule_runs (name, started_at, duration, status, error) VALUES (?, ?, ?, ?, ?)",
+        (name, started_at.isoformat(), duration, status, error)
+    )
+    conn.commit()
+
+
+def _run_history(conn: sqlite3.Connection, name: str, limit: int) -> list[dict]:
+    rows = conn.execute(
+        "SELECT started_at, duration, status, error FROM schedule_runs WHERE name = ? ORDER BY id DESC LIMIT ?",
+        (name, limit)
+    ).fetchall()
+    return [dict(zip(("started_at", "duration", "status", "error"), row)) for row in rows]
+
+
+async def get_run_history(name: str, limit: int = 10) -> list[dict]:
+    return await run_state(_run_history, name, limit)
+
+
+async def get_schedule_info() -> list[dict]:
+    """Расписания, время следующего запуска и последний запуск — для /jobs"""
+    info = []
+    for job in scheduled_jobs:
+        history = await get_run_history(job.name, 1)
+        info.append({
+            "name": job.name,
+            "spec": job.cron.spec,
+            "next_run": job.next_run,
+            "last": history[0] if history else None
+        })
+    return info
+
+
+def _submit(bot: Bot, job: ScheduledJob, scheduled_for: datetime):
+    async def run():
+        started_at = datetime.now(MSK)
+        started = time.monotonic()
+        status, error = "done", None
+        try:
+            await job.func(bot)
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        except Exception as e:
+            status, error = "failed", f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            await run_state(_record_run, job.name, started_at, time.monotonic() - started, status, error)
+
+    try:
+        _, created = job_runner.submit(job.name, None, run)
+    except JobQueueFull:
+        logger.warning(f"⚠️ Очередь задач заполнена, запуск {job.name} на {scheduled_for:%d.%m %H:%M} пропущен")
+        return
+    if not created:
+        logger.info(f"{job.name} уже выполняется — запуск на {scheduled_for:%d.%m %H:%M} пропущен")
+
+
+async def run_scheduler(bot: Bot):
+    now = datetime.now(MSK)
+    saved = await run_state(_load_next_runs)
+    for job in scheduled_jobs:
+        missed = saved.get(job.name)
+        job.next_run = job.cron.next_after(now)
+        if missed and missed <= now:
+            # Бот был выключен в момент запуска — догоняем один раз, без повтора каждого пропуска
+            logger.info(f"🔁 {job.name}: пропущен запуск {missed:%d.%m %H:%M}, выполняем сейчас")
+            _submit(bot, job, missed)
+            await run_state(_save_schedule, job.name, job.next_run, now)
+        else:
+            await run_state(_save_schedule, job.name, job.next_run)
+        logger.info(f"{job.name} ({job.cron.spec}): следующий запуск {job.next_run:%d.%m.%Y %H:%M} МСК")
+
+    while True:
+        now = datetime.now(MSK)
+        for job in scheduled_jobs:
+            if job.next_run <= now:
+                scheduled_for = job.next_run
+                _submit(bot, job, scheduled_for)
+                # Следующий запуск считаем от расписания, а не от конца выполнения — без дрейфа
+                job.next_run = job.cron.next_after(max(scheduled_for, now))
+                await run_state(_save_schedule, job.name, job.next_run, scheduled_for)
+        wait = min(job.next_run for job in scheduled_jobs) - datetime.now(MSK)
+        await asyncio.sleep(min(max(wait.total_seconds(), 0), SCHEDULER_MAX_SLEEP))
@@ -0,0 +1,79 @@
+# bot/sheets.py
+import os
+import logging
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+import gspread
+from google.oauth2.service_account import Credentials
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SPREADSHEET_NAME = os.getenv("SPREADSHEET_NAME")
+CREDENTIALS_PATH = os.getenv("GOOGLE_CREDENTIALS_PATH")
+# gspread и google-auth синхронные: выполняем их в отдельном пуле, чтобы не блокировать бота
+SHEETS_WORKERS = int(os.getenv("SHEETS_WORKERS", "2"))
+
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+
+_executor = ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix="sheets")
+
+# Один клиент на процесс: AuthorizedSession сам обновляет токен, когда тот истекает
+_client: Optional[gspread.Client] = None
+_spreadsheet: Optional[gspread.Spreadsheet] = None
+# Листы вместе с метаданными (sheetId, размер сетки) — по названию
+_worksheets: dict[str, gspread.Worksheet] = {}
+_lock = threading.RLock()
+
+
+def get_client() -> gspread.Client:
+    global _client
+    with _lock:
+        if _client is None:
+            creds = Credentials.from_service_account_file(CREDENTIALS_PATH, scopes=SCOPES)
+            _client = gspread.authorize(creds)
+            logger.info("Клиент Google Sheets создан")
+        return _client
+
+
+def get_worksheet(title: str) -> gspread.Worksheet:
+    """Лист из кэша; при промахе метаданные всех листов загружаются одним запросом"""
+    global _spreadsheet
+    with _lock:
+        worksheet = _worksheets.get(title)
+        if worksheet is None:
+            if _spreadsheet is None:
+                _spreadsheet = get_client().open(SPREADSHEET_NAME)
+            _worksheets.clear()
+            _worksheets.update({ws.title: ws for ws in _spreadsheet.worksheets()})
+            if title not in _worksheets:
+                raise gspread.WorksheetNotFound(title)
+            worksheet = _worksheets[title]
+        return worksheet
+
+
+def invalidate_sheets_cache():
+    """Сбрасывает таблицу и листы: следующий вызов заново прочитает метаданные"""
+    global _spreadsheet
+    with _lock:
+        _spreadsheet = None
+        _worksheets.clear()
+
+
+async def run_sheets(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Выполняет блокирующий вызов Google Sheets в пуле потоков; число потоков ограничивает параллелизм"""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+    except Exception:
+        # Лист могли переименовать, удалить или изменить его размер — метаданные больше не верны
+        invalidate_sheets_cache()
+        raise
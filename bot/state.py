@@ -0,0 +1,177 @@
+# bot/state.py
+import os
+import logging
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Служебное состояние бота (рассылки, журналы доставки и т.п.), отдельно от referrals.db
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", os.path.join("data", "state", "bot.db"))
+
+# Как и в bot/referrals.py: один поток и одно долгоживущее соединение, event loop не ждёт SQLite
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-db")
+_conn: Optional[sqlite3.Connection] = None
+
+
+# Миграции схемы по порядку; номер последней применённой хранится в PRAGMA user_version.
+# Таблицы могли появиться до версионирования, поэтому везде IF NOT EXISTS
+MIGRATIONS = [
+    # Водяные знаки инкрементальных выгрузок и другие небольшие отметки вида имя → значение
+    lambda conn: conn.execute('''
+        CREATE TABLE IF NOT EXISTS marks (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        )
+    '''),
+    # Рассылки и их получатели (bot/broadcast.py)
+    lambda conn: conn.executescript('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER,
+            text TEXT,
+            status TEXT DEFAULT 'running',
+            created_at TEXT,
+            finished_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER,
+            tg_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            error TEXT,
+            PRIMARY KEY (broadcast_id, tg_id)
+        );
+    '''),
+    # Журнал напоминаний: одно на (пользователь, дата окончания, вид напоминания) (bot/notifier.py)
+    lambda conn: conn.executescript('''
+        CREATE TABLE IF NOT EXISTS notify_ledger (
+            tg_id TEXT,
+            expiry INTEGER,
+            kind TEXT,
+            status TEXT,
+            sent_at TEXT,
+            PRIMARY KEY (tg_id, expiry, kind)
+        );
+        CREATE TABLE IF NOT EXISTS notify_runs (
+            run_date TEXT PRIMARY KEY,
+            started_at TEXT,
+            finished_at TEXT
+        );
+    '''),
+    # Кэш username по tg_id (bot/usernames.py)
+    lambda conn: conn.execute('''
+        CREATE TABLE IF NOT EXISTS usernames (
+            tg_id INTEGER PRIMARY KEY,
+            username TEXT,
+            found INTEGER,
+            fetched_at REAL
+        )
+    '''),
+    # Журнал платежей (bot/payments.py)
+    lambda conn: conn.executescript('''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,
+            provider TEXT,
+            tg_id INTEGER,
+            chat_id INTEGER,
+            plan TEXT,
+            months INTEGER,
+            status TEXT,
+            applied INTEGER DEFAULT 0,
+            created_at REAL,
+            updated_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_payments_tg ON payments (tg_id, status);
+    '''),
+    # Расписания и история их запусков (bot/scheduler.py)
+    lambda conn: conn.executescript('''
+        CREATE TABLE IF NOT EXISTS schedules (
+            name TEXT PRIMARY KEY,
+            last_run_at TEXT,
+            next_run_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS schedule_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            started_at TEXT,
+            duration REAL,
+            status TEXT,
+            error TEXT
+        );
+    '''),
+]
+
+
+def _migrate(conn: sqlite3.Connection):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        # PRAGMA не принимает параметры
+        conn.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+        logger.info(f"Схема служебной базы обновлена до версии {number}")
+
+
+# Подключение к SQLite; вызывать только из потока _db_executor
+def get_state_conn() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(STATE_DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(STATE_DB_PATH)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _migrate(conn)
+        _conn = conn
+    return _conn
+
+
+async def run_state(fn: Callable[..., Any], *args) -> Any:
+    """Выполняет fn(conn, *args) в потоке служебной базы"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, lambda: fn(get_state_conn(), *args))
+
+
+async def init_state_db():
+    """Открывает базу и применяет миграции; вызывается один раз при старте"""
+    await run_state(lambda conn: None)
+
+
+def _close_conn():
+    global _conn
+    if _conn is None:
+        return
+    _conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    _conn.close()
+    _conn = None
+
+
+async def close_state_db():
+    """Закрывает соединение при остановке бота"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_db_executor, _close_conn)
+
+
+def _get_mark(conn: sqlite3.Connection, name: str) -> Optional[str]:
+    row = conn.execute("SELECT value FROM marks WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_mark(conn: sqlite3.Connection, name: str, value: Optional[str]):
+    if value is None:
+        conn.execute("DELETE FROM marks WHERE name = ?", (name,))
+    else:
+        conn.execute("INSERT OR REPLACE INTO marks (name, value) VALUES (?, ?)", (name, value))
+    conn.commit()
+
+
+async def get_mark(name: str) -> Optional[str]:
+    return await run_state(_get_mark, name)
+
+
+async def set_mark(name: str, value: Optional[str]):
+    await run_state(_set_mark, name, value)
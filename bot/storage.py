@@ -1,4 +1,5 @@
 import os
+import logging
 import shutil
 from datetime import datetime
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -7,6 +8,8 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 UPLOAD_DIR = os.getenv("FILES_DIR", "./data/uploads")
 ADMIN_IDS = [int(uid) for uid in os.getenv("ADMIN_ID", "").split(",") if uid.strip().isdigit()]
 
@@ -35,7 +38,7 @@ async def notify_admins(bot, file_path: str, user_id: int, caption: str = None):
                 caption=caption or f"📩 Новый файл от пользователя {user_id}",
             )
         except Exception as e:
-            print(f"[STORAGE] ❌ Ошибка отправки файла админу {admin_id}: {e}")
+            logger.error(f"❌ Ошибка отправки файла админу {admin_id}: {e}")
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
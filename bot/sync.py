@@ -1,28 +1,32 @@
 # bot/sync.py
 
 import os
-import gspread
-from google.oauth2.service_account import Credentials
+import logging
 from datetime import datetime
+from typing import Optional
 from aiogram import Bot
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-from .api import get_all_clients
+from .api import get_all_clients_with_failures, panel_priority, PanelUnavailableError, BACKGROUND
 from gspread_formatting import Color
-from bot.referrals import export_to_gsheet
+from bot.referrals import export_to_gsheet, retry_pending_bonuses
+from bot.usernames import resolve_usernames
+from bot.sheets import run_sheets, get_worksheet, invalidate_sheets_cache
+from bot.state import get_mark, set_mark
+from bot.metrics import track_task
+from bot.utils import LoopLagMonitor, parse_tg_id
 
 # Загрузка .env
 load_dotenv()
 
-SPREADSHEET_NAME = os.getenv("SPREADSHEET_NAME")
+logger = logging.getLogger(__name__)
+
 SHEET_NAME = os.getenv("SHEET_NAME")
-CREDENTIALS_PATH = os.getenv("GOOGLE_CREDENTIALS_PATH")
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_ID", "").split(",") if x.strip()]
-
-SCOPES = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive"
-]
+# Порог задержки event loop во время синхронизации, в секундах
+SYNC_LOOP_LAG_THRESHOLD = float(os.getenv("SYNC_LOOP_LAG_THRESHOLD", "0.1"))
+# Вместо подсветки при каждой синхронизации один раз установить условное форматирование
+SHEETS_CONDITIONAL_FORMAT = os.getenv("SHEETS_CONDITIONAL_FORMAT", "0") == "1"
 
 # Цвета подсветки
 GREEN = {"red": 0.85, "green": 0.94, "blue": 0.85}
@@ -30,31 +34,231 @@ RED   = {"red": 0.96, "green": 0.80, "blue": 0.80}
 YELLOW= {"red": 1.0,  "green": 0.98, "blue": 0.8}
 BLUE = {"red": 0.8, "green": 0.9, "blue": 1.0}
 
+HEADER = ["TG ID", "Username", "Имя", "Дата начала", "Дата окончания", "Сумма", "Статус"]
+
+
+def plan_sheet_diff(all_rows: list[list[str]], desired: dict[str, list],
+                    delete_missing: bool = True) -> tuple[list, list, list]:
+    """Сравнивает лист с нужными строками.
+
+    Возвращает диапазоны значений для batch_update, диапазоны строк на удаление
+    (1-based, [start, end), от нижних к верхним) и итоговое содержимое листа с заголовком.
+    delete_missing=False — строки клиентов, которых нет в desired, остаются как есть
+    (список клиентов неполный, и отсутствие в нём не значит, что клиента удалили).
+    """
+    value_ranges = []
+    if not all_rows or all_rows[0][:len(HEADER)] != HEADER:
+        value_ranges.append({"range": "A1:G1", "values": [HEADER]})
+
+    seen = set()
+    to_delete = []
+    result = [HEADER]
+    for row_number, row in enumerate(all_rows[1:], start=2):
+        tg_id = row[0] if row else ""
+        if not tg_id:
+            result.append(row)
+            continue
+        if tg_id not in seen and tg_id not in desired and not delete_missing:
+            seen.add(tg_id)
+            result.append(row)
+            continue
+        if tg_id in seen or tg_id not in desired:
+            # Клиента больше нет в панели или строка — дубль
+            to_delete.append(row_number)
+            continue
+        seen.add(tg_id)
+        new_row = desired[tg_id]
+        padded = row + [""] * (len(new_row) - len(row))
+        if padded[:len(new_row)] != new_row:
+            value_ranges.append({"range": f"A{row_number}:G{row_number}", "values": [new_row]})
+        result.append(new_row)
+
+    # Новые строки дописываем одним диапазоном после последней существующей строки
+    appended = [row for tg_id, row in desired.items() if tg_id not in seen]
+    if appended:
+        # На пустом листе строка 1 — заголовок, данные начинаются со второй
+        first = max(len(all_rows), 1) + 1
+        value_ranges.append({"range": f"A{first}:G{first + len(appended) - 1}", "values": appended})
+        result.extend(appended)
+
+    # Соседние строки удаляем одним диапазоном; снизу вверх, чтобы номера выше не сдвигались
+    delete_ranges = []
+    for row_number in reversed(to_delete):
+        if delete_ranges and delete_ranges[-1][0] == row_number + 1:
+            delete_ranges[-1][0] = row_number
+        else:
+            delete_ranges.append([row_number, row_number + 1])
+    return value_ranges, [tuple(r) for r in delete_ranges], result
+
+
+def _open_sheet():
+    sheet = get_worksheet(SHEET_NAME)
+    return sheet, sheet.get_all_values()
+
+
+def _write_diff(sheet, value_ranges: list, delete_ranges: list, result: list):
+    # Новые строки пишутся до удаления старых, поэтому места нужно на обе части
+    needed_rows = len(result) + sum(end - start for start, end in delete_ranges)
+    if needed_rows > sheet.row_count:
+        sheet.add_rows(needed_rows - sheet.row_count)
+    if value_ranges:
+        sheet.batch_update(value_ranges)
+    if delete_ranges:
+        sheet.spreadsheet.batch_update({"requests": [
+            {
+                "deleteDimension": {
+                    "range": {
+                        "sheetId": sheet.id,
+                        "dimension": "ROWS",
+                        "startIndex": start - 1,
+                        "endIndex": end - 1
+                    }
+                }
+            }
+            for start, end in delete_ranges
+        ]})
+        # Размер сетки в кэше после удаления строк устарел — перечитаем метаданные в следующий раз
+        invalidate_sheets_cache()
+
+
+def _row_color(row: list, today_msk: str) -> Optional[dict]:
+    status = row[6].strip().lower() if len(row) > 6 else ""
+    expiry_str = row[4].strip() if len(row) > 4 else ""
+    if status == "активен":
+        return GREEN
+    if status == "истёк":
+        return RED
+    if status == "безлимит":
+        return BLUE
+    if expiry_str == today_msk:
+        return YELLOW
+    return None
+
+
+def _build_highlight_requests(sheet_id: int, result: list, today_msk: str) -> list[dict]:
+    # Соседние строки одного цвета красим одним диапазоном
+    runs = []
+    for i, row in enumerate(result[1:], start=1):
+        color = _row_color(row, today_msk)
+        if not color:
+            continue
+        if runs and runs[-1][1] == i and runs[-1][2] is color:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1, color])
+
+    return [
+        {
+            "repeatCell": {
+                "range": {
+                    "sheetId": sheet_id,
+                    "startRowIndex": start,
+                    "endRowIndex": end,
+                    "startColumnIndex": 0,
+                    "endColumnIndex": 7
+                },
+                "cell": {
+                    "userEnteredFormat": {
+                        "backgroundColor": color
+                    }
+                },
+                "fields": "userEnteredFormat.backgroundColor"
+            }
+        }
+        for start, end, color in runs
+    ]
+
+
+def _build_conditional_format_requests(sheet_id: int) -> list[dict]:
+    """Правила условного форматирования по колонке «Статус» — те же цвета, что и у подсветки"""
+    # Срабатывает первое подходящее правило, поэтому жёлтое (окончание сегодня) — последним
+    formulas = [
+        ('=TRIM($G2)="Активен"', GREEN),
+        ('=TRIM($G2)="Истёк"', RED),
+        ('=TRIM($G2)="Безлимит"', BLUE),
+        ('=TRIM($E2)=TEXT(TODAY(),"dd.mm.yyyy")', YELLOW),
+    ]
+    data_range = {"sheetId": sheet_id, "startRowIndex": 1, "startColumnIndex": 0, "endColumnIndex": 7}
+    # Статическая заливка от прежней подсветки больше не нужна
+    requests = [{
+        "repeatCell": {
+            "range": data_range,
+            "cell": {"userEnteredFormat": {}},
+            "fields": "userEnteredFormat.backgroundColor"
+        }
+    }]
+    for index, (formula, color) in enumerate(formulas):
+        requests.append({
+            "addConditionalFormatRule": {
+                "index": index,
+                "rule": {
+                    "ranges": [data_range],
+                    "booleanRule": {
+                        "condition": {"type": "CUSTOM_FORMULA", "values": [{"userEnteredValue": formula}]},
+                        "format": {"backgroundColor": color}
+                    }
+                }
+            }
+        })
+    return requests
+
+
+async def _apply_highlight(sheet, result: list, today_msk: str):
+    if SHEETS_CONDITIONAL_FORMAT:
+        # Правила ставятся один раз, дальше таблица красит строки сама
+        mark_name = f"sheets_conditional_format:{sheet.id}"
+        if not await get_mark(mark_name):
+            await run_sheets(sheet.spreadsheet.batch_update,
+                             {"requests": _build_conditional_format_requests(sheet.id)})
+            await set_mark(mark_name, datetime.now().isoformat(timespec="seconds"))
+            logger.info("Правила условного форматирования установлены")
+        return
+
+    requests = _build_highlight_requests(sheet.id, result, today_msk)
+    if requests:
+        await run_sheets(sheet.spreadsheet.batch_update, {"requests": requests})
+
+
 async def sync_to_google_sheets(bot: Bot):
-    creds = Credentials.from_service_account_file(CREDENTIALS_PATH, scopes=SCOPES)
-    client = gspread.authorize(creds)
-    sheet = client.open(SPREADSHEET_NAME).worksheet(SHEET_NAME)
+    # Весь обмен с Google идёт в пуле потоков, а задержку event loop при этом измеряем
+    with track_task("sync"):
+        async with LoopLagMonitor() as lag:
+            await _sync(bot)
+    logger.info(f"Максимальная задержка event loop: {lag.max_lag * 1000:.0f} мс")
+    if lag.max_lag > SYNC_LOOP_LAG_THRESHOLD:
+        logger.warning(f"⚠️ Задержка event loop выше порога {SYNC_LOOP_LAG_THRESHOLD * 1000:.0f} мс")
 
-    header = ["TG ID", "Username", "Имя", "Дата начала", "Дата окончания", "Сумма", "Статус"]
-    all_rows = sheet.get_all_values()
+
+async def _sync(bot: Bot):
+    sheet, all_rows = await run_sheets(_open_sheet)
     existing = {row[0]: row for row in all_rows[1:] if row and row[0]}
 
-    clients = await get_all_clients()
-    updates = []
+    with panel_priority(BACKGROUND):
+        clients, failed_nodes = await get_all_clients_with_failures()
+    if failed_nodes and not clients:
+        # Ни один узел не ответил — пустой список стёр бы всю таблицу
+        raise PanelUnavailableError(f"узлы не ответили: {', '.join(failed_nodes)}")
+    if failed_nodes:
+        # Строки клиентов с неответивших узлов удалять нельзя: вместе с ними пропали бы «Дата начала» и «Сумма»
+        logger.warning(f"⚠️ Узлы не ответили ({', '.join(failed_nodes)}): строки обновляются, удаление пропущено")
+    # tg_id -> строка в том виде, в каком она должна быть в таблице
+    desired = {}
     today_msk = datetime.now(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y")
     now_ts = datetime.now().timestamp() * 1000
+    usernames = await resolve_usernames(bot, (c["tgId"] for c in clients if c.get("tgId")))
 
     for client_data in clients:
         tg_id_raw = client_data.get("tgId")
-        if tg_id_raw is None:
+        if not tg_id_raw:
             continue
 
         tg_id = str(tg_id_raw)
-        try:
-            user = await bot.get_chat(int(tg_id))
-            username = f"@{user.username}" if user.username else "Без username"
-        except Exception:
+        # Нечисловой tgId в Telegram не найти — строка остаётся с «Не найден»
+        username = usernames.get(parse_tg_id(tg_id))
+        if username is None:
             username = "Не найден"
+        else:
+            username = f"@{username}" if username else "Без username"
 
         comment = client_data.get("comment", "")
         expiry = client_data.get("expiryTime", 0)
@@ -74,91 +278,45 @@ async def sync_to_google_sheets(bot: Bot):
                     f"\u26a0\ufe0f Подписка пользователя {comment} ({username}) истекает сегодня ({expiry_str})"
                 )
 
+        # Один tgId может быть у нескольких клиентов — в таблицу идёт первый
+        if tg_id in desired:
+            continue
+
         old_row = existing.get(tg_id)
         new_row = [tg_id, username, comment, "", expiry_str, "", status]
+        if old_row:
+            # «Дата начала» и «Сумма» заполняются вручную — сохраняем их
+            new_row[3] = old_row[3] if len(old_row) > 3 else ""
+            new_row[5] = old_row[5] if len(old_row) > 5 else ""
+        desired[tg_id] = new_row
 
-        if not old_row:
-            updates.append(new_row)
-        else:
-            changed = False
-            for i in [1, 2, 4, 6]:
-                if len(old_row) <= i or old_row[i] != new_row[i]:
-                    changed = True
-                    break
-            if changed:
-                new_row[3] = old_row[3] if len(old_row) > 3 else ""
-                new_row[5] = old_row[5] if len(old_row) > 5 else ""
-                updates.append(new_row)
-
-    tg_ids_in_sheet = set(existing.keys())
-    tg_ids_current = {str(c.get("tgId")) for c in clients if c.get("tgId")}
-    removed_ids = tg_ids_in_sheet - tg_ids_current
-    print(f"[sync] Обновляем {len(updates)} строк, удалено {len(removed_ids)}")
-
-    result = [header]
-    for row in all_rows[1:]:
-        tg_id = row[0]
-        if tg_id in removed_ids:
-            continue
-        updated_row = next((r for r in updates if r[0] == tg_id), None)
-        result.append(updated_row if updated_row else row)
-    for row in updates:
-        if row[0] not in tg_ids_in_sheet:
-            result.append(row)
+    value_ranges, delete_ranges, result = plan_sheet_diff(all_rows, desired, delete_missing=not failed_nodes)
+    logger.info(
+        f"Изменено строк: {len(value_ranges)}, удалено: {sum(e - s for s, e in delete_ranges)}, "
+        f"всего в таблице: {len(result) - 1}"
+    )
 
-    # Очистка и обновление таблицы
+    # Пишем только изменения: значения одним batch_update, удаление строк — отдельным запросом
     try:
-        sheet.batch_clear(["A2:G1000"])
-        sheet.update("A1:G1", [header])
-        if len(result) > 1:
-            sheet.update("A2", result[1:])
+        await run_sheets(_write_diff, sheet, value_ranges, delete_ranges, result)
     except Exception as e:
-        print(f"[sync] \u274c Ошибка при обновлении таблицы: {e}")
+        logger.error(f"\u274c Ошибка при обновлении таблицы: {e}")
 
     # Подсветка строк по статусу
     try:
-        requests = []
-        for i, row in enumerate(result[1:], start=2):
-            status = row[6].strip().lower() if len(row) > 6 else ""
-            expiry_str = row[4].strip() if len(row) > 4 else ""
-            color = None
-
-            if status == "активен":
-                color = GREEN
-            elif status == "истёк":
-                color = RED
-            elif status == "безлимит":
-                color = BLUE
-            elif expiry_str == today_msk:
-                color = YELLOW
-
-            if color:
-                requests.append({
-                    "repeatCell": {
-                        "range": {
-                            "sheetId": sheet._properties["sheetId"],
-                            "startRowIndex": i - 1,
-                            "endRowIndex": i,
-                            "startColumnIndex": 0,
-                            "endColumnIndex": 7
-                        },
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": color
-                            }
-                        },
-                        "fields": "userEnteredFormat.backgroundColor"
-                    }
-                })
-
-        if requests:
-            sheet.spreadsheet.batch_update({"requests": requests})
+        await _apply_highlight(sheet, result, today_msk)
+    except Exception as e:
+        logger.warning(f"\u26a0\ufe0f Ошибка при применении подсветки: {e}")
 
+    try:
+        # Заодно применяем бонусы, отложенные из-за недоступной панели
+        with panel_priority(BACKGROUND):
+            await retry_pending_bonuses(bot)
     except Exception as e:
-        print(f"[sync] \u26a0\ufe0f Ошибка при применении подсветки: {e}")
+        logger.warning(f"⚠️ Ошибка при начислении реферальных бонусов: {e}")
 
     try:
         await export_to_gsheet()
     except Exception as e:
-        print(f"[sync] ⚠️ Ошибка при синхронизации реферальной таблицы: {e}")
+        logger.warning(f"⚠️ Ошибка при синхронизации реферальной таблицы: {e}")
 
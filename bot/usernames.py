@@ -0,0 +1,92 @@
+# bot/usernames.py
+import os
+import logging
+import time
+import asyncio
+import sqlite3
+from typing import Iterable, Optional
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest, TelegramForbiddenError
+from bot.broadcast import TokenBucket
+from bot.metrics import CACHE_REQUESTS
+from bot.state import run_state
+from bot.utils import parse_tg_id
+
+logger = logging.getLogger(__name__)
+
+# Сколько хранить найденный username и сколько — отметку «чат не найден»
+USERNAME_TTL = float(os.getenv("USERNAME_TTL", str(24 * 3600)))
+USERNAME_NEGATIVE_TTL = float(os.getenv("USERNAME_NEGATIVE_TTL", str(6 * 3600)))
+USERNAME_CONCURRENCY = int(os.getenv("USERNAME_CONCURRENCY", "8"))
+USERNAME_RATE = float(os.getenv("USERNAME_RATE", "20"))
+
+# SQLite ограничивает число параметров в одном запросе
+_SQL_CHUNK = 500
+
+_bucket = TokenBucket(USERNAME_RATE)
+
+
+# Таблица usernames создаётся миграциями в bot/state.py
+def _load_cached(conn: sqlite3.Connection, tg_ids: list[int]) -> dict[int, Optional[str]]:
+    now = time.time()
+    cached = {}
+    for i in range(0, len(tg_ids), _SQL_CHUNK):
+        chunk = tg_ids[i:i + _SQL_CHUNK]
+        rows = conn.execute(
+            f"SELECT tg_id, username, found, fetched_at FROM usernames WHERE tg_id IN ({','.join('?' * len(chunk))})",
+            chunk
+        )
+        for tg_id, username, found, fetched_at in rows:
+            ttl = USERNAME_TTL if found else USERNAME_NEGATIVE_TTL
+            if now - fetched_at < ttl:
+                cached[tg_id] = username if found else None
+    return cached
+
+
+def _store(conn: sqlite3.Connection, results: dict[int, Optional[str]]):
+    now = time.time()
+    conn.executemany(
+        "INSERT OR REPLACE INTO usernames (tg_id, username, found, fetched_at) VALUES (?, ?, ?, ?)",
+        [(tg_id, username or "", 0 if username is None else 1, now) for tg_id, username in results.items()]
+    )
+    conn.commit()
+
+
+async def _fetch(bot: Bot, tg_id: int, semaphore: asyncio.Semaphore) -> tuple[bool, Optional[str]]:
+    """Возвращает (можно ли кэшировать, username | "" | None)"""
+    async with semaphore:
+        for _ in range(2):
+            await _bucket.acquire()
+            try:
+                chat = await bot.get_chat(tg_id)
+                return True, chat.username or ""
+            except TelegramRetryAfter as e:
+                _bucket.pause(e.retry_after)
+            except (TelegramBadRequest, TelegramForbiddenError):
+                return True, None
+            except Exception as e:
+                # Сетевые ошибки не кэшируем — попробуем в следующий раз
+                logger.warning(f"⚠️ Не удалось получить чат {tg_id}: {e}", extra={"sample": "username_lookup"})
+                return False, None
+    return False, None
+
+
+async def resolve_usernames(bot: Bot, tg_ids: Iterable) -> dict[int, Optional[str]]:
+    """username без @, "" — если username не задан, None — если чат не найден; нечисловые tgId пропускаются"""
+    ids = list({tg_id for tg_id in map(parse_tg_id, tg_ids) if tg_id is not None})
+    result = await run_state(_load_cached, ids)
+    missing = [tg_id for tg_id in ids if tg_id not in result]
+    CACHE_REQUESTS.inc(len(ids) - len(missing), cache="usernames", result="hit")
+    CACHE_REQUESTS.inc(len(missing), cache="usernames", result="miss")
+    if missing:
+        semaphore = asyncio.Semaphore(USERNAME_CONCURRENCY)
+        fetched = await asyncio.gather(*(_fetch(bot, tg_id, semaphore) for tg_id in missing))
+        to_store = {}
+        for tg_id, (cacheable, username) in zip(missing, fetched):
+            result[tg_id] = username
+            if cacheable:
+                to_store[tg_id] = username
+        if to_store:
+            await run_state(_store, to_store)
+        logger.info(f"Из кэша: {len(ids) - len(missing)}, запрошено: {len(missing)}")
+    return result
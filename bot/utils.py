@@ -1,9 +1,12 @@
 import uuid
+import time
 import random
 import string
+import asyncio
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 from pathlib import Path
+from typing import Callable, Optional
 
 def generate_uuid() -> str:
     return str(uuid.uuid4())
@@ -37,6 +40,13 @@ def is_expiring_soon(expiry: datetime) -> bool:
     tomorrow = today + timedelta(days=1)
     return expiry.date() in (today, tomorrow)
 
+def parse_tg_id(value) -> Optional[int]:
+    """tgId из панели как число; старые версии 3x-ui допускали там username — тогда None"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
 def is_admin(tg_id: int) -> bool:
     from os import getenv
     return str(tg_id) in getenv("ADMIN_ID", "")
@@ -54,3 +64,36 @@ def load_terms_text() -> str:
         return terms_path.read_text(encoding="utf-8")
     except Exception:
         return "⚠️ Правила временно недоступны."
+
+class LoopLagMonitor:
+    """Измеряет задержку event loop: насколько позже запланированного просыпается sleep"""
+
+    def __init__(self, interval: float = 0.05, on_lag: Optional[Callable[[float], None]] = None):
+        self.interval = interval
+        self.max_lag = 0.0
+        # Вызывается с каждым замером, например для гистограммы в /metrics
+        self.on_lag = on_lag
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            self.max_lag = max(self.max_lag, lag)
+            if self.on_lag:
+                self.on_lag(lag)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.stop()
@@ -0,0 +1,81 @@
+# bot/web.py
+import os
+import logging
+from typing import Optional
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from dotenv import load_dotenv
+from bot.metrics import render
+from bot.payments import handle_notification
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# HTTP-сервер: вебхук Telegram (BOT_MODE=webhook), уведомления ЮKassa и /health; /metrics — на своём порту.
+# В режиме polling без WEB_PORT не запускается
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = os.getenv("WEB_PORT")
+YOOKASSA_WEBHOOK_PATH = os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa/webhook")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# /metrics слушает отдельный порт, по умолчанию только локально: наружу он не нужен
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8081"))
+# Если задан, Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token; запросы без него отклоняются
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+
+async def yookassa_webhook(request: web.Request) -> web.Response:
+    try:
+        data = await request.json()
+    except Exception:
+        return web.Response(status=400)
+    try:
+        await handle_notification(request.app["bot"], data)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обработки уведомления ЮKassa: {e}")
+    # ЮKassa повторяет уведомление, пока не получит 200; статус всё равно перепроверит сверщик
+    return web.Response(status=200)
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok", "mode": "webhook" if request.app["dispatcher"] else "polling"})
+
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"})
+
+
+def build_app(bot: Bot, dp: Optional[Dispatcher] = None) -> web.Application:
+    """Приложение aiohttp; с dp принимает апдейты Telegram на WEBHOOK_PATH"""
+    app = web.Application()
+    app["bot"] = bot
+    app["dispatcher"] = dp
+    app.router.add_post(YOOKASSA_WEBHOOK_PATH, yookassa_webhook)
+    app.router.add_get("/health", health)
+    if dp:
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    return app
+
+
+async def start_metrics_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"📈 Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
+async def start_web_server(bot: Bot, dp: Optional[Dispatcher] = None) -> Optional[web.AppRunner]:
+    if not WEB_PORT and not dp:
+        return None
+    port = int(WEB_PORT or "8080")
+    runner = web.AppRunner(build_app(bot, dp))
+    await runner.setup()
+    await web.TCPSite(runner, WEB_HOST, port).start()
+    logger.info(f"🌐 HTTP-сервер слушает {WEB_HOST}:{port}")
+    return runner
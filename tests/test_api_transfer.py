@@ -0,0 +1,155 @@
+import json
+import asyncio
+import pytest
+from typing import Optional
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from bot import api
+
+# Фейковая панель 3x-ui: много inbound'ов с клиентами, чтобы полный список был заметно тяжелее одного inbound
+INBOUNDS = 10
+CLIENTS_PER_INBOUND = 50
+USER_TG_ID = 1000 + 3 * CLIENTS_PER_INBOUND + 7
+USER_INBOUND = 4
+
+
+def _make_inbounds() -> list[dict]:
+    inbounds = []
+    for inbound_id in range(1, INBOUNDS + 1):
+        clients = [
+            {
+                "id": f"uuid-{inbound_id}-{n}",
+                "email": f"user_{1000 + (inbound_id - 1) * CLIENTS_PER_INBOUND + n}",
+                "tgId": str(1000 + (inbound_id - 1) * CLIENTS_PER_INBOUND + n),
+                "subId": f"sub-{inbound_id}-{n}",
+                "expiryTime": 1893456000000,
+                "enable": True,
+            }
+            for n in range(CLIENTS_PER_INBOUND)
+        ]
+        inbounds.append({"id": inbound_id, "remark": f"in-{inbound_id}", "settings": json.dumps({"clients": clients})})
+    return inbounds
+
+
+def _fake_panel(targeted_api: bool, inbounds: Optional[list[dict]] = None) -> web.Application:
+    inbounds = inbounds if inbounds is not None else _make_inbounds()
+    by_id = {inbound["id"]: inbound for inbound in inbounds}
+
+    async def login(request):
+        return web.json_response({"success": True})
+
+    async def inbound_list(request):
+        return web.json_response({"success": True, "obj": inbounds})
+
+    async def inbound_get(request):
+        if not targeted_api:
+            raise web.HTTPNotFound()
+        return web.json_response({"success": True, "obj": by_id.get(int(request.match_info["id"]))})
+
+    async def client_traffic(request):
+        if not targeted_api:
+            raise web.HTTPNotFound()
+        email = request.match_info["email"]
+        for inbound in inbounds:
+            if email in inbound["settings"]:
+                return web.json_response({"success": True, "obj": {"email": email, "inboundId": inbound["id"]}})
+        return web.json_response({"success": True, "obj": None})
+
+    async def update_client(request):
+        return web.json_response({"success": True})
+
+    app = web.Application()
+    app.router.add_post("/login", login)
+    app.router.add_post("/panel/inbound/list", inbound_list)
+    app.router.add_get("/panel/api/inbounds/get/{id}", inbound_get)
+    app.router.add_get("/panel/api/inbounds/getClientTraffics/{email}", client_traffic)
+    app.router.add_post("/panel/inbound/updateClient/{client_id}", update_client)
+    return app
+
+
+def _bytes(stats: dict, *ops: str) -> int:
+    return sum(stats.get(op, {}).get("bytes", 0) for op in ops)
+
+
+async def _run(targeted_api: bool, scenario, inbounds: Optional[list[dict]] = None) -> dict:
+    server = TestServer(_fake_panel(targeted_api, inbounds))
+    await server.start_server()
+    panel = api.PanelClient("main", str(server.make_url("")), "admin", "admin")
+    panel.targeted_api = targeted_api
+    saved = api.panels, api.DEFAULT_NODE, api.client_index
+    api.panels, api.DEFAULT_NODE = {"main": panel}, "main"
+    api.client_index = api.ClientIndex(api.CLIENT_INDEX_TTL)
+    api.transfer_stats.clear()
+    try:
+        await scenario()
+        return api.get_transfer_stats()
+    finally:
+        api.panels, api.DEFAULT_NODE, api.client_index = saved
+        await panel.close()
+        await server.close()
+
+
+@pytest.mark.parametrize("targeted_api", [True, False])
+def test_update_user_expiry(targeted_api):
+    async def scenario():
+        ok = await api.update_user_expiry(USER_INBOUND, f"uuid-{USER_INBOUND}-7", 1900000000000)
+        assert ok
+
+    stats = asyncio.run(_run(targeted_api, scenario))
+    if targeted_api:
+        assert "list_inbounds" not in stats
+        assert stats["get_inbound"]["requests"] == 1
+    else:
+        assert stats["list_inbounds"]["requests"] == 1
+
+
+def test_update_user_expiry_reads_less_than_list_scan():
+    async def scenario():
+        assert await api.update_user_expiry(USER_INBOUND, f"uuid-{USER_INBOUND}-7", 1900000000000)
+
+    targeted = asyncio.run(_run(True, scenario))
+    legacy = asyncio.run(_run(False, scenario))
+    read_ops = ("get_inbound", "list_inbounds")
+    # Один inbound из десяти — примерно десятая часть полного списка
+    assert _bytes(targeted, *read_ops) * 5 < _bytes(legacy, *read_ops)
+
+
+def test_find_user_by_tg_reads_less_than_list_scan():
+    async def targeted_scenario():
+        # Индекс построен, но устарел: известный пользователь перечитывается одним inbound
+        await api.get_all_clients()
+        api.transfer_stats.clear()
+        api.client_index.built_at = 1.0
+        user = await api.find_user_by_tg(USER_TG_ID, allow_stale=False)
+        assert user and user["inbound_id"] == USER_INBOUND
+
+    async def list_scan_scenario():
+        user = await api.find_user_by_tg(USER_TG_ID, allow_stale=False)
+        assert user and user["inbound_id"] == USER_INBOUND
+
+    targeted = asyncio.run(_run(True, targeted_scenario))
+    legacy = asyncio.run(_run(False, list_scan_scenario))
+    assert "list_inbounds" not in targeted
+    assert legacy["list_inbounds"]["requests"] == 1
+    assert _bytes(targeted, "get_inbound", "list_inbounds") * 5 < _bytes(legacy, "get_inbound", "list_inbounds")
+
+
+def test_find_user_for_write_rereads_fresh_index():
+    inbounds = _make_inbounds()
+    inbound = inbounds[USER_INBOUND - 1]
+
+    async def scenario():
+        await api.get_all_clients()
+        # Админ изменил дату в панели, индекс ещё свежий и помнит старую
+        settings = json.loads(inbound["settings"])
+        settings["clients"][7]["expiryTime"] = 1900000000000
+        inbound["settings"] = json.dumps(settings)
+        assert api.client_index.is_fresh()
+
+        cached = await api.find_user_by_tg(USER_TG_ID)
+        assert cached["expiryTime"] == 1893456000000
+        user = await api.find_user_by_tg(USER_TG_ID, allow_stale=False)
+        assert user["expiryTime"] == 1900000000000
+
+    stats = asyncio.run(_run(True, scenario, inbounds))
+    assert stats["get_inbound"]["requests"] == 1
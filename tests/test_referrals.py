@@ -0,0 +1,181 @@
+import asyncio
+import json
+from bot import referrals
+from bot.api import PanelUnavailableError
+
+
+def _setup(tmp_path, monkeypatch, extend):
+    monkeypatch.setattr(referrals, "DB_PATH", str(tmp_path / "referrals.db"))
+    monkeypatch.setattr(referrals, "REF_BONUS_THRESHOLD", 2)
+
+    async def find_user_by_tg(tg_id, allow_stale=True, raise_unavailable=False):
+        return {"expiryTime": 1893456000000, "inbound_id": 1, "client": {"id": "uuid"}}
+
+    monkeypatch.setattr(referrals, "find_user_by_tg", find_user_by_tg)
+    monkeypatch.setattr(referrals, "extend_subscription", extend)
+
+
+async def _invite_and_pay(count: int):
+    for invited in range(1, count + 1):
+        await referrals.save_referral(100, invited, "code")
+        await referrals.run_db(referrals._mark_as_paid, invited)
+
+
+def _states(conn):
+    return conn.execute("SELECT tier, state FROM referral_bonuses ORDER BY tier").fetchall()
+
+
+def test_timed_out_extension_is_not_retried(tmp_path, monkeypatch):
+    calls = []
+
+    async def extend(user, months):
+        calls.append(months)
+        # Запрос мог дойти до панели, но ответа мы не дождались
+        raise asyncio.TimeoutError()
+
+    _setup(tmp_path, monkeypatch, extend)
+
+    async def scenario():
+        try:
+            await _invite_and_pay(2)
+            first = await referrals.process_bonuses(["100"])
+            second = await referrals.retry_pending_bonuses()
+            return first, second, await referrals.run_db(_states)
+        finally:
+            await referrals.close_db()
+
+    first, second, states = asyncio.run(scenario())
+    assert (first, second) == (0, 0)
+    assert calls == [1]
+    assert states == [(1, referrals.BONUS_FAILED)]
+
+
+def test_applied_tier_is_granted_once(tmp_path, monkeypatch):
+    calls = []
+
+    async def extend(user, months):
+        calls.append(months)
+        return True
+
+    _setup(tmp_path, monkeypatch, extend)
+
+    async def scenario():
+        try:
+            await _invite_and_pay(4)
+            first = await referrals.process_bonuses(["100"])
+            second = await referrals.retry_pending_bonuses()
+            return first, second, await referrals.run_db(_states)
+        finally:
+            await referrals.close_db()
+
+    first, second, states = asyncio.run(scenario())
+    assert (first, second) == (1, 0)
+    assert calls == [2]
+    assert states == [(1, referrals.BONUS_DONE), (2, referrals.BONUS_DONE)]
+
+
+def test_retry_applies_only_recorded_pending_tiers(tmp_path, monkeypatch):
+    calls = []
+    panel_up = False
+
+    async def extend(user, months):
+        calls.append(months)
+        return True
+
+    _setup(tmp_path, monkeypatch, extend)
+
+    async def find_user_by_tg(tg_id, allow_stale=True, raise_unavailable=False):
+        if not panel_up:
+            raise PanelUnavailableError("панель недоступна")
+        return {"expiryTime": 1893456000000, "inbound_id": 1, "client": {"id": "uuid"}}
+
+    monkeypatch.setattr(referrals, "find_user_by_tg", find_user_by_tg)
+
+    async def scenario():
+        nonlocal panel_up
+        try:
+            await _invite_and_pay(2)
+            # Панель недоступна до записи — ступень остаётся в очереди
+            assert await referrals.process_bonuses(["100"]) == 0
+            # Оплаты, прошедшие мимо mark_as_paid, повтор не пересчитывает
+            await referrals.save_referral(200, 10, "code2")
+            await referrals.save_referral(200, 11, "code2")
+            await referrals.run_db(lambda conn: (conn.execute("UPDATE referrals SET is_paid = 1"), conn.commit()))
+            panel_up = True
+            applied = await referrals.retry_pending_bonuses()
+            rows = await referrals.run_db(
+                lambda conn: conn.execute("SELECT inviter_tg_id, tier, state FROM referral_bonuses").fetchall()
+            )
+            return applied, rows
+        finally:
+            await referrals.close_db()
+
+    applied, rows = asyncio.run(scenario())
+    assert applied == 1
+    assert calls == [1]
+    assert rows == [("100", 1, referrals.BONUS_DONE)]
+
+class _FakeWorksheet:
+    """Лист Google Sheets в памяти: только вызовы, которые делает выгрузка рефералов"""
+
+    def __init__(self):
+        self.rows: list[list] = []
+        self.row_count = 1000
+
+    @staticmethod
+    def _start(range_name: str) -> int:
+        return int(range_name.split(":")[0][1:])
+
+    def _write(self, start: int, values: list):
+        while len(self.rows) < start - 1 + len(values):
+            self.rows.append([])
+        for i, row in enumerate(values):
+            self.rows[start - 1 + i] = list(row)
+
+    def clear(self):
+        self.rows = []
+
+    def resize(self, rows: int):
+        self.row_count = rows
+
+    def add_rows(self, count: int):
+        self.row_count += count
+
+    def update(self, values, range_name):
+        self._write(self._start(range_name), values)
+
+    def batch_update(self, value_ranges):
+        for value_range in value_ranges:
+            self._write(self._start(value_range["range"]), value_range["values"])
+
+    def col_values(self, column: int) -> list:
+        return [row[column - 1] if len(row) >= column else "" for row in self.rows]
+
+
+def test_export_of_changed_rows_keeps_watermark(tmp_path, monkeypatch):
+    from bot import state
+
+    monkeypatch.setattr(referrals, "DB_PATH", str(tmp_path / "referrals.db"))
+    monkeypatch.setattr(state, "STATE_DB_PATH", str(tmp_path / "bot.db"))
+    worksheet = _FakeWorksheet()
+    monkeypatch.setattr(referrals, "get_worksheet", lambda tab: worksheet)
+
+    async def scenario():
+        try:
+            for invited in range(1, 6):
+                await referrals.save_referral(100, invited, "code")
+            await referrals.export_to_gsheet()
+            # Только изменённая строка, новых нет
+            await referrals.run_db(referrals._mark_as_paid, 1)
+            await referrals.export_to_gsheet()
+            await referrals.export_to_gsheet()
+            return json.loads(await state.get_mark(referrals.REF_EXPORT_MARK))
+        finally:
+            await referrals.close_db()
+            await state.close_state_db()
+
+    mark = asyncio.run(scenario())
+    assert mark["rowid"] == 5
+    assert len(worksheet.rows) == 6
+    assert [row[1] for row in worksheet.rows[1:]] == ["1", "2", "3", "4", "5"]
+    assert worksheet.rows[1][5] == "1"
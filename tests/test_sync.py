@@ -0,0 +1,54 @@
+from bot.sync import HEADER, plan_sheet_diff
+
+
+def _row(tg_id: str) -> list:
+    return [tg_id, "user", "Имя", "01.01.2025", "01.02.2025", "", "Активна"]
+
+
+def test_empty_sheet_writes_header_then_data():
+    desired = {"1": _row("1"), "2": _row("2")}
+    value_ranges, delete_ranges, result = plan_sheet_diff([], desired)
+
+    assert value_ranges == [
+        {"range": "A1:G1", "values": [HEADER]},
+        {"range": "A2:G3", "values": [_row("1"), _row("2")]},
+    ]
+    assert delete_ranges == []
+    assert result == [HEADER, _row("1"), _row("2")]
+
+
+def test_header_only_sheet_appends_after_header():
+    value_ranges, _, result = plan_sheet_diff([HEADER], {"1": _row("1")})
+
+    assert value_ranges == [{"range": "A2:G2", "values": [_row("1")]}]
+    assert result == [HEADER, _row("1")]
+
+
+def test_changed_removed_and_new_rows():
+    all_rows = [HEADER, _row("1"), _row("2"), _row("3")]
+    changed = _row("2")
+    changed[6] = "Истекла"
+    desired = {"1": _row("1"), "2": changed, "4": _row("4")}
+
+    value_ranges, delete_ranges, result = plan_sheet_diff(all_rows, desired)
+
+    assert value_ranges == [
+        {"range": "A3:G3", "values": [changed]},
+        {"range": "A5:G5", "values": [_row("4")]},
+    ]
+    assert delete_ranges == [(4, 5)]
+    assert result == [HEADER, _row("1"), changed, _row("4")]
+
+
+def test_incomplete_client_list_keeps_missing_rows():
+    # Узел клиента 2 не ответил: его строка с ручными «Дата начала» и «Сумма» должна остаться
+    kept = _row("2")
+    kept[3], kept[5] = "01.12.2024", "300"
+    all_rows = [HEADER, _row("1"), kept, _row("1")]
+
+    value_ranges, delete_ranges, result = plan_sheet_diff(all_rows, {"1": _row("1")}, delete_missing=False)
+
+    assert value_ranges == []
+    # Дубль по-прежнему удаляется
+    assert delete_ranges == [(4, 5)]
+    assert result == [HEADER, _row("1"), kept]
@@ -0,0 +1,33 @@
+import asyncio
+from bot import state, usernames
+
+
+class _Chat:
+    def __init__(self, username: str):
+        self.username = username
+
+
+class _FakeBot:
+    def __init__(self):
+        self.requested = []
+
+    async def get_chat(self, tg_id: int):
+        self.requested.append(tg_id)
+        return _Chat(f"user{tg_id}")
+
+
+def test_non_numeric_tg_id_is_skipped(tmp_path, monkeypatch):
+    # Старые версии 3x-ui допускали в tgId username — такая строка не должна обрывать синхронизацию
+    monkeypatch.setattr(state, "STATE_DB_PATH", str(tmp_path / "bot.db"))
+    bot = _FakeBot()
+
+    async def scenario():
+        try:
+            return await usernames.resolve_usernames(bot, ["123", "@someone", "", None, 456])
+        finally:
+            await state.close_state_db()
+
+    result = asyncio.run(scenario())
+    assert result == {123: "user123", 456: "user456"}
+    assert sorted(bot.requested) == [123, 456]
+    assert result.get(None) is None
@@ -0,0 +1,64 @@
+import asyncio
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Message
+from bot import web
+
+SECRET = "test-secret"
+
+
+def _update(text: str) -> dict:
+    return {
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": 1700000000,
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }
+
+
+def test_webhook_accepts_fake_updates_with_secret(monkeypatch):
+    # Вебхук проверяется локально: фейковые апдейты без Telegram
+    monkeypatch.setattr(web, "WEBHOOK_SECRET", SECRET)
+    received = []
+
+    async def scenario():
+        handled = asyncio.Event()
+        router = Router()
+
+        @router.message()
+        async def on_message(message: Message):
+            received.append(message.text)
+            handled.set()
+
+        dp = Dispatcher()
+        dp.include_router(router)
+        bot = Bot(token="42:TEST_TOKEN_TEST_TOKEN_TEST_TOKEN_TEST")
+        client = TestClient(TestServer(web.build_app(bot, dp)))
+        await client.start_server()
+        try:
+            response = await client.post(
+                web.WEBHOOK_PATH, json=_update("wrong"),
+                headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+            )
+            assert response.status == 401
+
+            response = await client.post(
+                web.WEBHOOK_PATH, json=_update("hello"),
+                headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}
+            )
+            assert response.status == 200
+            await asyncio.wait_for(handled.wait(), 5)
+
+            response = await client.get("/health")
+            assert response.status == 200
+            assert await response.json() == {"status": "ok", "mode": "webhook"}
+        finally:
+            await client.close()
+            await bot.session.close()
+
+    asyncio.run(scenario())
+    assert received == ["hello"]